@@ -18,6 +18,9 @@ setup_kwargs = {
     'package_dir': {'': 'src'},
     'include_package_data': True,
     'install_requires': [ ],
+    'extras_require': {
+        'columnar': [ 'numpy' ],
+    },
     'entry_points': '''
         [console_scripts]
         wgtrack=wgtrack:main
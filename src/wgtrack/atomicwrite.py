@@ -1,46 +1,84 @@
 # -*- coding: utf-8 -*-
 
 import contextlib
+import hashlib
+import io
 import os
 import stat
 import sys
 import tempfile
 
 
+written = dict() # filename -> tuple of content digest and file signature of the last write (for skipping unchanged content)
+
+
+def get_signature(info):
+    '''Returns what identifies a version of a file (to notice changes by others)'''
+    return (info.st_ino, info.st_size, info.st_mtime_ns, info.st_mode, info.st_uid, info.st_gid)
+
+def fsync_directory(path):
+    '''Makes sure that a rename in the given directory is stored durably'''
+    fd = os.open(path or '.', os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 @contextlib.contextmanager
-def open_for_atomic_write(filename, text=True, uid=None, gid=None, perm=None, tmp_suffix='.bak', tmp_prefix='tmp_', tmp_keep=True):
-    '''Context manager for overwriting a file atomically.'''
+def open_for_atomic_write(filename, text=True, uid=None, gid=None, perm=None, tmp_suffix='.bak', tmp_prefix='tmp_', tmp_keep=False,
+                          fsync=False, skip_unchanged=True):
+    '''Context manager for overwriting a file atomically.
+       The content is staged in memory; with "skip_unchanged", the file is not touched if it did not change since the last write
+       (only useful for content that does not contain timestamps or counters; otherwise it just costs hashing).
+       Owner and permissions are applied to the temporary file before renaming (taken from the file replaced if not given).
+       With "fsync", the file and the directory entry are flushed to disk.'''
+    # Stage content in memory
+    buffer = io.StringIO() if text else io.BytesIO()
+    yield buffer
+    content = buffer.getvalue()
+    if text:
+        content = content.encode('utf-8')
+    # Skip writing if the content is the same as last time and the file was not changed meanwhile
+    digest = hashlib.blake2b(content, digest_size=16).digest() if skip_unchanged else None
+    try:
+        info = os.stat(filename)
+    except FileNotFoundError:
+        info = None
+    if skip_unchanged and (info is not None) and (written.get(filename) == (digest, get_signature(info))):
+        return
+    # Determine owner and permissions
+    if info is not None:
+        if uid is None:
+            uid = info.st_uid
+        if gid is None:
+            gid = info.st_gid
+        if perm is None:
+            perm = stat.S_IMODE(info.st_mode)
     # Create temporary file
     path = os.path.dirname(filename)
     fd, filetmp = tempfile.mkstemp(dir=path, text=text, suffix=tmp_suffix, prefix=tmp_prefix)
     try:
-        # Open remporary file for writing
-        with os.fdopen(fd, 'w' if text else 'wb') as f:
-            yield f
+        # Write temporary file and set owner and permissions
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            if (uid is not None) or (gid is not None):
+                os.fchown(f.fileno(), -1 if uid is None else uid, -1 if gid is None else gid)
+            if perm is not None:
+                os.fchmod(f.fileno(), perm)
+            if fsync:
+                os.fsync(f.fileno())
         # Rename to target
         os.replace(filetmp, filename) # atomic on POSIX systems and Windows for Python 3.3+
         filetmp = None
-        # Set owner and permissions
-        if any(x is None for x in (uid, gid, perm)):
-            try:
-                info = os.stat(filename)
-                if uid is None:
-                    uid = info.st_uid
-                if gid is None:
-                    gid = info.st_gid
-                if perm is None:
-                    perm = stat.S_IMODE(info.st_mode)
-            except FileNotFoundError:
-                pass
-        if uid is None:
-            uid = -1
-        if gid is None:
-            gid = -1
-        os.chown(filename, uid, gid)
-        if perm is not None:
-            os.chmod(filename, perm)
+        if fsync:
+            fsync_directory(path)
+        if skip_unchanged:
+            written[filename] = (digest, get_signature(os.stat(filename)))
+        else:
+            written.pop(filename, None)
     finally: # Silently try to delete the temporary file if needed
-        if (filetmp is not None) and not tmp_keep: 
+        if (filetmp is not None) and not tmp_keep:
             try:
                 os.unlink(filetmp)
             except:
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the status pipeline (parsing, iterating, logic, output) with synthetic WireGuard data of various sizes"""
+
+import asyncio
+import base64
+import getopt
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import config
+from . import datakeeper
+from . import logic
+from . import output
+from . import wg_command
+
+
+logger = logging.getLogger(__name__);
+
+SIZES = [100, 1000, 10000, 100000] # default numbers of peers
+
+
+def generate_key(rnd):
+    '''Returns a random key in WireGuard's base64 format'''
+    return base64.b64encode(rnd.getrandbits(256).to_bytes(32, 'big')).decode('ascii')
+
+def generate_dump(interfaces=4, peers=1000, now=None, seed=1):
+    '''Returns synthetic output of "wg show all dump" with the given number of peers spread over the interfaces'''
+    rnd = random.Random(seed)
+    if now is None:
+        now = int(time.time())
+    lines = []
+    for i in range(interfaces):
+        interface = 'wg{0}'.format(i)
+        lines.append('\t'.join([interface, generate_key(rnd), generate_key(rnd), str(51820 + i), 'off']))
+        for j in range(i, peers, interfaces):
+            kind = rnd.random() # mix of handshake ages as seen on real systems
+            if kind < 0.6:
+                latest_handshake = now - rnd.randint(0, 110) # ok
+            elif kind < 0.65:
+                latest_handshake = now - rnd.randint(125, 134) # pending
+            elif kind < 0.7:
+                latest_handshake = now - rnd.randint(140, 175) # retrying
+            elif kind < 0.85:
+                latest_handshake = now - rnd.randint(300, 86400) # failed
+            else:
+                latest_handshake = 0 # none
+            if (latest_handshake == 0) and (rnd.random() < 0.5):
+                endpoint = '(none)'
+            elif rnd.random() < 0.8:
+                endpoint = '198.51.{0}.{1}:{2}'.format((j >> 8) & 0xff, j & 0xff, rnd.randint(1024, 65535))
+            else:
+                endpoint = '[2001:db8::{0:x}]:{1}'.format(j, rnd.randint(1024, 65535))
+            allowed_ips = '10.{0}.{1}.{2}/32'.format((j >> 16) & 0xff, (j >> 8) & 0xff, j & 0xff)
+            if rnd.random() < 0.3:
+                allowed_ips += ',fd00::{0:x}/128'.format(j)
+            transfer_rx = rnd.randint(0, 1 << 34) if latest_handshake else 0
+            transfer_tx = rnd.randint(0, 1 << 34) if latest_handshake else 0
+            lines.append('\t'.join([interface, generate_key(rnd), generate_key(rnd) if rnd.random() < 0.2 else '(none)', endpoint, allowed_ips,
+                                    str(latest_handshake), str(transfer_rx), str(transfer_tx), '25' if rnd.random() < 0.5 else 'off']))
+    return '\n'.join(lines) + '\n'
+
+
+class DumpCommand(wg_command.WireguardCommand):
+    '''WireGuard command replacement that returns the given dump instead of executing "wg"'''
+
+    def __init__(self, dump, interface='all'):
+        '''Constructor'''
+        self.dump = dump
+        super().__init__(interface)
+
+    def execute_wg_show(self, suppressoutput=True, suppresserrors=False):
+        '''Returns the dump'''
+        return self.dump
+
+    async def execute_wg_show_async(self, timeout=None, suppressoutput=True, suppresserrors=False):
+        '''Returns the dump'''
+        return self.dump
+
+    async def execute_wg_set_peers_async(self, interface, attr, values, timeout=None):
+        '''Pretends to set the attribute'''
+        return dict()
+
+
+class BenchmarkDataKeeper(datakeeper.DataKeeper):
+    '''DataKeeper that uses the given dump instead of the WireGuard command and config files'''
+
+    def __init__(self, config, dump):
+        '''Constructor'''
+        self.dump = dump
+        super().__init__(config)
+
+    def initialize(self):
+        '''Initializes the data structures from the dump; every other peer gets a hostname endpoint configured'''
+        self.wgcmd = DumpCommand(self.dump)
+        self.wgcmd.retrieve_wireguard_data()
+        self.data = self.wgcmd.data
+        for i, (interface, interfacedata, peer, peerdata) in enumerate(self.peeriterator()):
+            if i % 2 == 0:
+                peerdata['config_endpoint'] = 'peer{0}.example.net:51820'.format(i)
+        self.config_interfaces.update(self.get_interfaces()) # there are no config files to read
+
+
+class StubPinger():
+    '''Pinger replacement that reports every peer as reachable'''
+
+    async def ping(self, destination, interface, ping6=False):
+        '''Pretends a successful ping'''
+        return 0
+
+    def close(self):
+        '''Nothing to close'''
+        pass
+
+
+def measure(func, repeat=3):
+    '''Calls the function "repeat" times; returns the fastest duration (in seconds) and the peak memory (in bytes) of an extra traced call'''
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(durations), peak
+
+def run_benchmark(peers, interfaces=4, repeat=3):
+    '''Runs the benchmark for the given number of peers; returns a list of dictionaries with the results per stage'''
+    dump = generate_dump(interfaces, peers)
+    results = []
+
+    def add_result(stage, func):
+        duration, peak = measure(func, repeat)
+        results.append({ 'stage': stage, 'peers': peers, 'seconds': duration, 'peak-bytes': peak })
+
+    def parse_new():
+        DumpCommand(dump).parse_wg_output(dump)
+    add_result('parse (new)', parse_new)
+
+    wgcmd = DumpCommand(dump)
+    wgcmd.parse_wg_output(dump)
+    add_result('parse (update)', lambda: wgcmd.parse_wg_output(dump))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = config.Config()
+        cfg.read_dict({ 'general': { 'configfile': '', 'ping_interval': '1' },
+                        'output:influx': { 'filename': os.path.join(tmpdir, 'influx.out') } })
+        data = BenchmarkDataKeeper(cfg, dump)
+
+        def iterate():
+            for interface, interfacedata, peer, peerdata in data.peeriterator():
+                pass
+        add_result('peeriterator', iterate)
+
+        loop = asyncio.new_event_loop()
+        try:
+            async def enqueue(command, data):
+                pass
+            cfg_logic = config.Config()
+            cfg_logic.read_dict({ 'general': { 'configfile': '', 'ping_interval': '1', 'state_file': '' } }) # no outputs; these are measured separately
+            lg = logic.Logic(cfg_logic, enqueue, data=BenchmarkDataKeeper(cfg_logic, dump))
+            lg.pinger = StubPinger()
+
+            def do_periodically():
+                lg.next_cycle = time.monotonic() # start a new cycle with each call
+                loop.run_until_complete(lg.do_periodically())
+            do_periodically() # the first cycle looks at all peers
+            add_result('do_periodically', do_periodically)
+
+            influx_config = cfg.outputs['influx']
+            add_result('render_influx', lambda: output.render_influx(data))
+            add_result('output_status_influx', lambda: loop.run_until_complete(output.output_status_influx(influx_config, data)))
+        finally:
+            loop.close()
+    return results
+
+def usage():
+    """Show information on command line arguments"""
+    print('Usage: %s [-?|--help] [-i|--interfaces <number>] [-r|--repeat <number>] [-j|--json <file>] [<peers> ...]' % sys.argv[0])
+    print('Benchmark the status pipeline with synthetic WireGuard data')
+    print()
+    print('  -?, --help                        show program usage')
+    print('  -i, --interfaces <number>         number of interfaces the peers are spread over')
+    print('                                    default: 4')
+    print('  -r, --repeat <number>             number of runs per stage (the fastest counts)')
+    print('                                    default: 3')
+    print('  -j, --json <file>                 also write the results to a JSON file')
+    print('  <peers>                           numbers of peers to benchmark')
+    print('                                    default: {0}'.format(' '.join(str(size) for size in SIZES)))
+    print()
+
+def main():
+    '''Runs the benchmark as specified on the command line and prints the results'''
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:r:j:?', ['help', 'interfaces=', 'repeat=', 'json='])
+        sizes = [ int(arg) for arg in args ] if args else SIZES
+        interfaces, repeat, jsonfile = 4, 3, None
+        for o, a in opts:
+            if o in ('-?', '--help'):
+                usage()
+                sys.exit(0)
+            elif o in ('-i', '--interfaces'):
+                interfaces = int(a)
+            elif o in ('-r', '--repeat'):
+                repeat = int(a)
+            elif o in ('-j', '--json'):
+                jsonfile = a
+    except (getopt.GetoptError, ValueError) as ex:
+        print(ex)
+        usage()
+        sys.exit(2)
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(module)s: %(message)s', level=logging.ERROR)
+    results = []
+    print('{0:<22} {1:>8} {2:>12} {3:>12} {4:>12}'.format('stage', 'peers', 'time [ms]', 'per peer [us]', 'peak [KiB]'))
+    for size in sizes:
+        for result in run_benchmark(size, interfaces, repeat):
+            print('{stage:<22} {peers:>8} {ms:>12.2f} {us:>12.2f} {kib:>12.0f}'.format(stage=result['stage'], peers=result['peers'],
+                  ms=result['seconds'] * 1000, us=result['seconds'] * 1e6 / max(1, size), kib=result['peak-bytes'] / 1024))
+            results.append(result)
+    if jsonfile is not None:
+        with open(jsonfile, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""Source of time for all timing decisions; may be replaced by a virtual clock to simulate long periods quickly"""
+
+import asyncio
+import time as systime
+
+
+class SystemClock():
+    '''Clock based on the system time'''
+
+    def time(self):
+        '''Returns the current time in seconds since the epoch'''
+        return systime.time()
+
+    def monotonic(self):
+        '''Returns the value of a monotonic clock in seconds'''
+        return systime.monotonic()
+
+    async def sleep(self, delay):
+        '''Waits for the given number of seconds'''
+        await asyncio.sleep(delay)
+
+
+class VirtualClock():
+    '''Clock that only advances when sleeping (or when advanced explicitly); sleeping does not take any real time'''
+
+    def __init__(self, start=1600000000.0):
+        '''Constructor'''
+        self.now = start
+
+    def time(self):
+        '''Returns the current virtual time in seconds since the epoch'''
+        return self.now
+
+    def monotonic(self):
+        '''Returns the current virtual time'''
+        return self.now
+
+    def advance(self, seconds):
+        '''Advances the virtual time by the given number of seconds'''
+        self.now += max(0, seconds)
+
+    async def sleep(self, delay):
+        '''Advances the virtual time and lets other tasks run'''
+        self.advance(delay)
+        await asyncio.sleep(0)
+
+
+current = SystemClock()
+
+def set_clock(clock):
+    '''Replaces the clock used (None: system clock)'''
+    global current
+    current = SystemClock() if clock is None else clock
+
+def time():
+    '''Returns the current time in seconds since the epoch'''
+    return current.time()
+
+def monotonic():
+    '''Returns the value of a monotonic clock in seconds'''
+    return current.monotonic()
+
+async def sleep(delay):
+    '''Waits for the given number of seconds'''
+    await current.sleep(delay)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""Columnar store of numeric peer state for evaluating all peers at once (requires NumPy)"""
+
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger(__name__);
+
+HANDSHAKE_STATUSES = ['none', 'ok', 'pending', 'retrying', 'failed'] # index is the code used in the arrays
+HANDSHAKE_UNKNOWN = -1
+
+
+class ColumnarStore():
+    '''NumPy arrays with one row per peer (in the order of the WireGuard dump) for vectorized evaluation'''
+
+    def __init__(self):
+        '''Constructor (raises ImportError if NumPy is not available)'''
+        if numpy is None:
+            raise ImportError('NumPy is needed for the columnar store')
+        self.keys = [] # row -> tuple of interface and peer
+        self.index = dict() # tuple of interface and peer -> row
+        self.latest_handshake = numpy.zeros(0, dtype=numpy.int64)
+        self.handshake_status = numpy.zeros(0, dtype=numpy.int8) # code as index of HANDSHAKE_STATUSES
+
+    def reindex(self, keys):
+        '''Adapts the rows to the given peers (rows of peers seen before are kept); returns the handshake status codes in the new order'''
+        rows = numpy.array([ self.index.get(key, -1) for key in keys ], dtype=numpy.int64)
+        known = rows >= 0
+
+        def take(array, fill):
+            result = numpy.full(len(keys), fill, dtype=array.dtype)
+            result[known] = array[rows[known]]
+            return result
+
+        self.latest_handshake = take(self.latest_handshake, 0)
+        self.handshake_status = take(self.handshake_status, HANDSHAKE_UNKNOWN)
+        self.keys = list(keys)
+        self.index = { key: row for row, key in enumerate(self.keys) }
+
+    def evaluate(self, keys, records, now):
+        '''Evaluates the given peer records (in dump order) at once; returns the keys of the peers whose handshake status changed'''
+        if keys != self.keys:
+            self.reindex(keys)
+        count = len(records)
+        latest_handshake = numpy.fromiter((record.latest_handshake for record in records), dtype=numpy.int64, count=count)
+        # Classify handshakes (same limits as WireguardCommand.check_handshake; the handshake age is derived by the records themselves)
+        seconds = int(now) - latest_handshake
+        status = numpy.select([latest_handshake == 0, seconds <= 120, seconds <= 135, seconds <= 180], [0, 1, 2, 3], 4).astype(numpy.int8)
+        changed = numpy.flatnonzero(status != self.handshake_status)
+        self.latest_handshake, self.handshake_status = latest_handshake, status
+        # Write back the changed results to the records
+        for row in changed.tolist():
+            records[row].handshake_status = HANDSHAKE_STATUSES[status[row]]
+        return [ keys[row] for row in changed.tolist() ]
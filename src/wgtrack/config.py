@@ -24,6 +24,10 @@ class Config(configparser.ConfigParser):
     def cycle_time(self):
         return float(self['general'].get('cycle_time', 30))
 
+    @property
+    def cycle_time_degraded(self):
+        return float(self['general'].get('cycle_time_degraded', self.cycle_time))
+
     @property
     def cycles_wait(self):
         return int(self['general'].get('cycles_wait', 2))
@@ -44,10 +48,97 @@ class Config(configparser.ConfigParser):
     def ping_interval(self):
         return int(self['general'].get('ping_interval', 2))
 
+    @property
+    def ping_backend(self):
+        return self['general'].get('ping_backend', 'socket')
+
     @property
     def ping_failafternum(self):
         return int(self['general'].get('ping_failafternum', 2))
 
+    @property
+    def ping_passive(self):
+        return self['general'].getboolean('ping_passive', False)
+
+    @property
+    def status_backend(self):
+        return self['general'].get('status_backend', 'command')
+
+    @property
+    def status_store(self):
+        return self['general'].get('status_store', 'records')
+
+    @property
+    def history_size(self):
+        return int(self['general'].get('history_size', 10))
+
+    @property
+    def rate_samples(self):
+        return int(self['general'].get('rate_samples', 2))
+
+    @property
+    def watch_config(self):
+        return self['general'].getboolean('watch_config', False)
+
+    @property
+    def watch_debounce(self):
+        return float(self['general'].get('watch_debounce', 0.5))
+
+    @property
+    def config_cache(self):
+        return self['general'].get('config_cache', '/var/cache/wg-track_config.json')
+
+    @property
+    def state_file(self):
+        return self['general'].get('state_file', '')
+
+    @property
+    def state_interval(self):
+        return float(self['general'].get('state_interval', 300))
+
+    @property
+    def state_max_age(self):
+        return float(self['general'].get('state_max_age', 3600))
+
+    @property
+    def control_socket(self):
+        return self['general'].get('control_socket', '/run/wgtrack.sock')
+
+    @property
+    def queue_workers(self):
+        return max(1, int(self['general'].get('queue_workers', 4)))
+
+    @property
+    def queue_size(self):
+        return int(self['general'].get('queue_size', 1000))
+
+    @property
+    def wg_timeout(self):
+        return float(self['general'].get('wg_timeout', 10))
+
+    @property
+    def dns_backend(self):
+        return self['general'].get('dns_backend', 'builtin')
+
+    @property
+    def dns_nameservers(self):
+        nameservers = self['general'].get('dns_nameservers')
+        if nameservers is None:
+            return None # use the ones from resolv.conf
+        return [ ns.strip() for ns in nameservers.split(',') if ns.strip() ]
+
+    @property
+    def dns_timeout(self):
+        return float(self['general'].get('dns_timeout', 2))
+
+    @property
+    def dns_default_ttl(self):
+        return int(self['general'].get('dns_default_ttl', 60))
+
+    @property
+    def dns_negative_ttl(self):
+        return int(self['general'].get('dns_negative_ttl', 60))
+
     @property
     def loglevel(self):
         return int(self['general'].get('loglevel', logging.INFO))
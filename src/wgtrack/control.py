@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Control endpoint on a Unix socket for querying the status and sending commands (messages are JSON objects prefixed by their length)"""
+
+import asyncio
+import json
+import logging
+import os
+import stat
+import struct
+
+
+logger = logging.getLogger(__name__);
+
+LENGTH = struct.Struct('>I') # length of the message that follows (big endian)
+MAX_MESSAGE_SIZE = 1048576 # longer requests are rejected
+
+
+class ProtocolError(Exception):
+    '''Error in the framing of a message (the connection cannot be used any further)'''
+
+
+async def read_message(reader):
+    '''Reads a message; returns None at the end of the connection'''
+    try:
+        header = await reader.readexactly(LENGTH.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError('connection closed within a message header')
+    length = LENGTH.unpack(header)[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError('message of {0} bytes too long'.format(length))
+    return json.loads(await reader.readexactly(length))
+
+def encode_message(message):
+    '''Returns the message including its length prefix as bytes'''
+    body = json.dumps(message, separators=(',', ':'), default=str).encode('utf-8')
+    return LENGTH.pack(len(body)) + body
+
+async def request(path, message, timeout=5):
+    '''Sends a request to the control socket at the given path and returns the response (client side)'''
+    reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(path), timeout)
+    try:
+        writer.write(encode_message(message))
+        await writer.drain()
+        response = await asyncio.wait_for(read_message(reader), timeout)
+        if response is None:
+            raise ProtocolError('connection closed without response')
+        return response
+    finally:
+        writer.close()
+
+
+class ControlServer():
+    '''Serves requests of any number of clients concurrently; each request is answered by the given handler'''
+
+    def __init__(self, path, handler, mode=0o600, backlog=1024):
+        '''Constructor; "handler" is a coroutine function getting the request (dictionary) and returning the response (dictionary)'''
+        self.path = path
+        self.handler = handler
+        self.mode = mode # permissions of the socket (commands change the state; thus only for root by default)
+        self.backlog = backlog # connections waiting to be accepted (the default of 100 is too small for bursts of clients)
+        self.server = None
+        self.stats = { 'connections': 0, 'clients': 0, 'requests': 0, 'errors': 0 }
+
+    async def start(self):
+        '''Starts listening on the socket (a stale socket of a previous run is replaced)'''
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.server = await asyncio.start_unix_server(self.handle_client, self.path, backlog=self.backlog)
+        os.chmod(self.path, self.mode)
+        logger.info('Listening for control requests on [{0}]'.format(self.path))
+
+    async def stop(self):
+        '''Stops listening and removes the socket'''
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    async def handle_client(self, reader, writer):
+        '''Serves the requests of a client until it closes the connection'''
+        self.stats['connections'] += 1
+        self.stats['clients'] += 1
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except ValueError as e: # the framing is intact; the client may continue
+                    self.stats['errors'] += 1
+                    writer.write(encode_message({ 'ok': False, 'error': 'invalid JSON: {0}'.format(e) }))
+                    await writer.drain()
+                    continue
+                if message is None:
+                    break
+                self.stats['requests'] += 1
+                if not isinstance(message, dict):
+                    response = { 'ok': False, 'error': 'request is not a JSON object' }
+                else:
+                    try:
+                        response = await self.handler(message)
+                    except Exception as e:
+                        logger.error('Processing control request [{0}] failed: [{1}]'.format(message.get('command'), e))
+                        response = { 'ok': False, 'error': str(e) }
+                if not response.get('ok'):
+                    self.stats['errors'] += 1
+                writer.write(encode_message(response))
+                await writer.drain()
+        except ProtocolError as e:
+            self.stats['errors'] += 1
+            logger.debug('Closing control connection: [{0}]'.format(e))
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug('Control connection lost: [{0}]'.format(e))
+        finally:
+            self.stats['clients'] -= 1
+            writer.close()
+
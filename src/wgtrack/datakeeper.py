@@ -2,14 +2,23 @@
 
 """Class that maintains the data (attributes and values of interfaces and peers) and makes it accessible"""
 
+import asyncio
 import collections
 import enum
+import hashlib
 import logging
 import os
 import pprint
+import time
 
+from . import atomicwrite
+from . import clock
+from . import columnar
+from . import history
+from . import snapshot
 from . import wg_config
 from . import wg_command
+from . import wg_netlink
 
 
 logger = logging.getLogger(__name__);
@@ -22,27 +31,204 @@ class DataKeeper():
         '''Constructor'''
         self.cfg = config
         self.configfile = config['general']['configfile']        
+        self.stats = dict()
+        self.pending_endpoints = collections.defaultdict(dict) # interface -> peer -> endpoint
+        self.apply_lock = asyncio.Lock()
+        self.history = history.History(capacity=config.history_size, rate_samples=config.rate_samples)
+        self.config_files = dict() # path -> signature of config files read (modification time, size, and content hash)
+        self.config_snapshots = dict() # interface -> parsed WireGuard config applied to the data tree
+        self.config_interfaces = set() # interfaces whose WireGuard config file has been read
+        self.config_cache = None # cache of parsed WireGuard config files
+        self.config_applied = [] # tuples of section name and key set in the data tree from the wgtrack config file
         self.initialize()
 
     def initialize(self):
         '''Reads the config and initializes the data structures'''
-        # WireGuard command for status information
-        self.wgcmd = wg_command.WireguardCommand()
+        start = time.monotonic()
+        # WireGuard command (or netlink) for status information
+        if self.cfg.status_backend == 'netlink':
+            self.wgcmd = wg_netlink.WireguardNetlink()
+        else:
+            self.wgcmd = wg_command.WireguardCommand()
+        if self.cfg.status_store == 'columnar':
+            try:
+                self.wgcmd.columns = columnar.ColumnarStore()
+            except ImportError as e:
+                logger.warning('Cannot use columnar store [{0}]; evaluating peers one by one'.format(e))
         self.wgcmd.retrieve_wireguard_data()
         self.data = self.wgcmd.data
+        time_status = time.monotonic()
         # WireGuard config files
         self.wgcfg = wg_config.WireguardConfig()
-        self.wgcfg.retrieve_wireguard_config(self.get_interfaces(), self.data, 'config_')
+        self.config_files, self.config_snapshots, self.config_interfaces = dict(), dict(), set()
+        self.config_cache = wg_config.ConfigCache(self.cfg.config_cache) if self.cfg.config_cache else None
+        for interface in list(self.get_interfaces()):
+            self.apply_wireguard_config(interface, self.read_wireguard_config(interface))
+        time_wgconfig = time.monotonic()
         # Merge config file content into data tree
         self.cfg.read(self.configfile)
+        self.config_files[self.configfile] = self.get_file_signature(self.configfile)
+        self.config_applied = []
+        self.apply_config()
+        time_config = time.monotonic()
+        self.save_config_cache()
+        time_cache = time.monotonic()
+        logger.debug('Initialized in {0:.1f}ms: WireGuard status {1:.1f}ms, {2} WireGuard config file(s) {3:.1f}ms ({4} from cache), config file {5:.1f}ms, saving config cache {6:.1f}ms'.format(
+                     (time_cache - start) * 1000, (time_status - start) * 1000, len(self.config_snapshots), (time_wgconfig - time_status) * 1000,
+                     0 if self.config_cache is None else self.config_cache.hits, (time_config - time_wgconfig) * 1000, (time_cache - time_config) * 1000))
+
+    def apply_config(self):
+        '''Merges the content of the wgtrack config file into the data tree'''
         for section in self.cfg.sections():
             if section == 'general':
                 for k, v in self.cfg[section].items():
                     self.data[k] = v
+                    self.config_applied.append((None, k))
             elif section.startswith('interface:'):
                 for k, v in self.cfg[section].items():
                     self.data[section][k[10:]] = v
-        
+                    self.config_applied.append((section, k[10:]))
+
+    def get_file_signature(self, path, previous=None):
+        '''Returns modification time, size, and content hash of the given file (None if it does not exist); the content is only hashed if needed'''
+        try:
+            info = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if (previous is not None) and (previous[:2] == (info.st_mtime_ns, info.st_size)):
+            return previous
+        with open(path, 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).digest()
+        return (info.st_mtime_ns, info.st_size, digest)
+
+    def has_file_changed(self, path):
+        '''Checks whether the content of the given file changed since it was read the last time (and remembers its current signature)'''
+        previous = self.config_files.get(path)
+        signature = self.get_file_signature(path, previous)
+        self.config_files[path] = signature
+        if (signature is None) or (previous is None):
+            return signature != previous
+        return signature[2] != previous[2] # touched files with the same content did not change
+
+    def read_wireguard_config(self, interface):
+        '''Parses the WireGuard config file of the given interface (None if there is none); the config cache is used if the file did not change'''
+        path = os.path.join(self.wgcfg.configpath, interface + '.conf')
+        prefix = 'config_'
+        self.config_interfaces.add(interface)
+        try:
+            info = os.stat(path) # before reading so that a change while reading is noticed later
+            cached = None if self.config_cache is None else self.config_cache.get(path, info, prefix)
+            if cached is not None:
+                digest, config = cached
+            else:
+                with open(path, 'rb') as f:
+                    content = f.read()
+                digest = hashlib.blake2b(content, digest_size=16).digest()
+        except FileNotFoundError: # ignore missing config files (interface could have been configured by other means)
+            logger.info('No config file found for interface [{0}]'.format(interface))
+            self.config_files[path] = None
+            return None
+        self.config_files[path] = (info.st_mtime_ns, info.st_size, digest)
+        if cached is None:
+            wgcfg = wg_config.WireguardConfig()
+            wgcfg.parse_wg_config_lines(interface, content.decode('utf-8').splitlines(), prefix)
+            config = wg_config.strip_secrets(wgcfg.data.get(interface), prefix) # keys are not needed and must not be written to the cache
+            if self.config_cache is not None:
+                self.config_cache.put(path, info, prefix, digest, config)
+        return config
+
+    def save_config_cache(self):
+        '''Writes the config cache (if enabled and changed); entries of files no longer read are dropped'''
+        if self.config_cache is not None:
+            self.config_cache.save(self.config_files.keys())
+
+    def apply_wireguard_config(self, interface, config):
+        '''Applies the parsed WireGuard config of an interface to the data tree (only differences to the config applied before);
+           returns the peers whose config changed (as a set of tuples of interface and peer)'''
+        old = self.config_snapshots.pop(interface, None) or { 'peers': dict() }
+        if config is not None:
+            self.config_snapshots[interface] = config
+        else:
+            config = { 'peers': dict() }
+        interfacedata = self.data[interface]
+        peers = interfacedata.setdefault('peers', dict())
+        # Interface attributes
+        for k in old.keys() - config.keys():
+            interfacedata.pop(k, None)
+        for k, v in config.items():
+            if k != 'peers':
+                interfacedata[k] = v
+        # Peers
+        changed = set()
+        oldpeers, newpeers = old['peers'], config.get('peers', dict())
+        for peer in oldpeers.keys() - newpeers.keys(): # removed from the config
+            peerdata = peers.get(peer)
+            if peerdata is not None:
+                for k in oldpeers[peer]:
+                    peerdata.pop(k, None)
+                if peerdata.get('timestamp') is None: # not known by WireGuard either
+                    del peers[peer]
+            changed.add((interface, peer))
+        for peer, attrs in newpeers.items():
+            previous = oldpeers.get(peer)
+            if previous == attrs: # unchanged; keep as it is
+                continue
+            peerdata = peers.get(peer)
+            if peerdata is None:
+                peers[peer] = dict(attrs)
+            else: # merge in place to keep the runtime state
+                for k in (previous or dict()).keys() - attrs.keys():
+                    peerdata.pop(k, None)
+                peerdata.update(attrs)
+            changed.add((interface, peer))
+        return changed
+
+    def reload(self, paths=None):
+        '''Applies changes of the config files (only files that changed are read again; the state of unchanged peers is kept);
+           only the given files are looked at if "paths" is provided;
+           returns the peers that have been added, removed, or modified (as a set of tuples of interface and peer)'''
+        start = time.monotonic()
+        changed = set()
+        if paths is not None:
+            paths = { os.path.abspath(path) for path in paths }
+        # wgtrack config file
+        if self.configfile and ((paths is None) or (os.path.abspath(self.configfile) in paths)) and self.has_file_changed(self.configfile):
+            logger.info('Config file [{0}] changed; reading it again'.format(self.configfile))
+            for section, k in self.config_applied: # remove what has been set from the previous content
+                if section is None:
+                    self.data.pop(k, None)
+                elif section in self.data:
+                    self.data[section].pop(k, None)
+            self.config_applied = []
+            for section in self.cfg.sections():
+                self.cfg.remove_section(section)
+            self.cfg.defaults().clear()
+            self.cfg.read(self.configfile)
+            self.apply_config()
+        # WireGuard config files
+        interfaces = [ interface for interface, data in self.data.items() if isinstance(data, collections.abc.Mapping) and ('peers' in data) ]
+        for interface in self.config_snapshots.keys() - set(interfaces): # interface vanished
+            del self.config_snapshots[interface]
+        interfaces_changed = 0
+        for interface in interfaces:
+            path = os.path.join(self.wgcfg.configpath, interface + '.conf')
+            if (paths is not None) and (os.path.abspath(path) not in paths):
+                continue
+            if not self.has_file_changed(path):
+                continue
+            interfaces_changed += 1
+            changed |= self.apply_wireguard_config(interface, self.read_wireguard_config(interface))
+        if paths is not None: # files of interfaces that are not up yet are read once they appear (see "read_new_interfaces")
+            known = { os.path.abspath(os.path.join(self.wgcfg.configpath, interface + '.conf')) for interface in interfaces }
+            for path in sorted(paths - known):
+                if (os.path.dirname(path) == os.path.abspath(self.wgcfg.configpath)) and path.endswith('.conf'):
+                    logger.info('Config file [{0}] is read once its interface appears'.format(path))
+        if interfaces_changed > 0:
+            self.save_config_cache()
+        logger.info('Reloaded config in {0:.1f}ms; {1} of {2} WireGuard config file(s) changed, {3} peer(s) affected'.format(
+                    (time.monotonic() - start) * 1000, interfaces_changed, len(interfaces), len(changed)))
+        return changed
+
     def get(self, interface, peer, attr, default=None):
         '''Gets data matching the specified interface, peer, and attribute (None is allowed for each parameter to get all)'''
         if interface is None:
@@ -89,13 +275,136 @@ class DataKeeper():
                 for peer, peerdata in data.get('peers', dict()).items():
                     yield interface, interfacedata, peer, peerdata
 
+    def get_rates(self, interface, peer, samples=None):
+        '''Returns the receive and transmit rates (bytes per second) of the peer over the given number of recent samples (None if not available)'''
+        return self.history.get_rates(interface, peer, samples)
+
+    def get_changed_peers(self):
+        '''Returns the peers whose status information changed in the last update (as a set of tuples of interface and peer)'''
+        return self.wgcmd.changed_peers
+
+    def take_handshake_changes(self):
+        '''Returns the peers whose handshake status changed or that are new since the last call (as a set of tuples)'''
+        changes, self.wgcmd.handshake_changes = self.wgcmd.handshake_changes, set()
+        return changes
+
+    def read_new_interfaces(self):
+        '''Reads the WireGuard config files of interfaces that appeared after startup (e.g. by "wg-quick up");
+           returns the peers whose config has been applied (as a set of tuples of interface and peer)'''
+        changed = set()
+        for interface, interfacedata in list(self.data.items()):
+            if (interface in self.config_interfaces) or not (isinstance(interfacedata, collections.abc.Mapping) and ('peers' in interfacedata)):
+                continue
+            logger.info('Interface [{0}] appeared; reading its config file'.format(interface))
+            changed |= self.apply_wireguard_config(interface, self.read_wireguard_config(interface))
+        if changed:
+            self.save_config_cache()
+        return changed
+
     def update_status(self):
-        '''Updates the WireGuard status data'''
+        '''Updates the WireGuard status data; returns the peers of interfaces that appeared (see "read_new_interfaces")'''
         self.wgcmd.retrieve_wireguard_data(self.data)
+        changed = self.read_new_interfaces()
+        self.history.record(self.data)
+        return changed
+
+    async def update_status_async(self):
+        '''Updates the WireGuard status data without blocking the event loop; returns the peers of interfaces that appeared (see "read_new_interfaces")'''
+        timeout = self.cfg.wg_timeout
+        start = time.monotonic()
+        await self.wgcmd.retrieve_wireguard_data_async(self.data, timeout)
+        changed = self.read_new_interfaces()
+        self.history.record(self.data)
+        duration = time.monotonic() - start
+        self.stats['status-duration'] = duration
+        logger.debug('Retrieved WireGuard status in {0:.3f}s'.format(duration))
+        if duration > timeout / 2:
+            logger.warning('Retrieving the WireGuard status took {0:.3f}s (timeout is {1}s)'.format(duration, timeout))
+        return changed
+
+    def save_state(self, filename, cycle, dns_cache=None):
+        '''Writes the tracking state of the peers (and the given DNS cache) to a snapshot file; "cycle" is the number of the current cycle'''
+        start = time.monotonic()
+        now, now_monotonic = clock.time(), clock.monotonic()
+        interfaces = collections.defaultdict(dict)
+        for interface, interfacedata, peer, peerdata in self.peeriterator():
+            status = peerdata.get('status')
+            if status is None: # not looked at yet
+                continue
+            cycle_counter = peerdata.get('cycle-counter', 0)
+            synced = peerdata.get('cycle-synced')
+            if synced is not None: # include the cycles not counted yet as the peer has not been looked at
+                cycle_counter += cycle - synced
+            interfaces[interface][peer] = snapshot.PeerState(status, cycle_counter, peerdata.get('backingoff-limit'), peerdata.get('ping-failcounter', 0),
+                                                             snapshot.get_endpoint_checksum(peerdata.get('config_endpoint')), peerdata.get('transfer-previous'))
+        dns = { hostname: (now + expiry - now_monotonic, addresses) for hostname, (expiry, addresses) in (dns_cache or dict()).items() if expiry > now_monotonic }
+        try:
+            with atomicwrite.open_for_atomic_write(filename, text=False, skip_unchanged=False) as f: # the time saved changes each time
+                f.write(snapshot.pack(now, interfaces, dns))
+        except OSError as e:
+            logger.warning('Writing state to [{0}] failed: [{1}]'.format(filename, e))
+            return
+        logger.debug('Saved state of {0} peer(s) to [{1}] in {2:.1f}ms'.format(sum(len(peers) for peers in interfaces.values()), filename, (time.monotonic() - start) * 1000))
+
+    def restore_state(self, filename, max_age, cycle_time, dns_cache=None):
+        '''Restores the tracking state of the peers (and the DNS cache) from a snapshot file not older than "max_age" seconds;
+           the cycles passed since saving are taken into account; returns the number of peers restored'''
+        try:
+            with open(filename, 'rb') as f:
+                saved, interfaces, dns = snapshot.unpack(f.read())
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring state in [{0}] that cannot be read: [{1}]'.format(filename, e))
+            return 0
+        now, now_monotonic = clock.time(), clock.monotonic()
+        age = now - saved
+        if (age < 0) or (age > max_age):
+            logger.info('Ignoring state in [{0}] saved {1:.0f}s ago'.format(filename, age))
+            return 0
+        elapsed = int(age // cycle_time) # cycles passed while not running
+        restored = 0
+        for interface, peers in interfaces.items():
+            interfacedata = self.data.get(interface)
+            if not isinstance(interfacedata, collections.abc.Mapping):
+                continue
+            currentpeers = interfacedata.get('peers', dict())
+            for peer, state in peers.items():
+                peerdata = currentpeers.get(peer)
+                if peerdata is None:
+                    continue
+                if state.endpoint_checksum != snapshot.get_endpoint_checksum(peerdata.get('config_endpoint')): # config changed; start from scratch
+                    continue
+                peerdata['status'] = state.status
+                peerdata['cycle-counter'] = max(0, state.cycle_counter + elapsed)
+                peerdata['backingoff-limit'] = state.backingoff_limit
+                peerdata['ping-failcounter'] = state.ping_failcounter
+                if state.transfer_previous is not None:
+                    peerdata['transfer-previous'] = state.transfer_previous
+                restored += 1
+        if dns_cache is not None:
+            for hostname, (expiry, addresses) in dns.items():
+                if expiry > now:
+                    dns_cache.setdefault(hostname, (now_monotonic + expiry - now, addresses))
+        logger.info('Restored state of {0} peer(s) from [{1}] saved {2:.0f}s ago'.format(restored, filename, age))
+        return restored
 
     def set_endpoint(self, interface, peer, endpoint):
-        '''Updates the endpoint of the specified WireGuard peer'''
-        return self.wgcmd.execute_wg_set(interface, peer, 'endpoint', endpoint)
+        '''Requests to update the endpoint of the specified WireGuard peer (done by "apply_endpoints")'''
+        self.pending_endpoints[interface][peer] = endpoint
+
+    async def apply_endpoints(self):
+        '''Applies the requested endpoint changes with one WireGuard command per interface'''
+        async with self.apply_lock:
+            pending, self.pending_endpoints = self.pending_endpoints, collections.defaultdict(dict)
+            for interface, endpoints in pending.items():
+                logger.debug('Setting endpoints of {0} peer(s) of interface [{1}]'.format(len(endpoints), interface))
+                peers = list(endpoints.keys())
+                for i in range(0, len(peers), 256): # limit the length of the command line
+                    chunk = { peer: endpoints[peer] for peer in peers[i:i+256] }
+                    errors = await self.wgcmd.execute_wg_set_peers_async(interface, 'endpoint', chunk, self.cfg.wg_timeout)
+                    for peer, error in errors.items():
+                        logger.error('Error setting endpoint of [{0}:{1}] to [{2}]: {3}'.format(interface, peer, endpoints[peer], error))
 
 
 if __name__ == '__main__':
@@ -2,34 +2,77 @@
 
 import asyncio
 import concurrent
+import itertools
 import logging
+import os
 import pprint
 import signal
 import socket
 import sys
-import time
 
+from . import clock
+from . import control
 from . import logic
+from . import watcher
+from . import wg_config
 
 
 logger = logging.getLogger(__name__);
 
+PRIORITY_HIGH = 0 # events requested via the control socket are processed before all others
+PRIORITY_NORMAL = 1
+SECRET_FIELDS = { 'preshared-key', *wg_config.SECRET_KEYS, *('config_' + key for key in wg_config.SECRET_KEYS) } # never answered via the control socket
+
 
 class EventProcessor():
     '''Class for providing event processing for the application (uses an asyncio event loop)'''
 
-    def __init__(self, config):
-        '''Constructor'''
+    def __init__(self, config, data=None):
+        '''Constructor (a DataKeeper instance may be provided instead of creating one)'''
         self.config = config
         self.loop = asyncio.get_event_loop()
         # no longer working with Python 3.10: self.queue = asyncio.Queue(loop=self.loop)
-        self.queue = asyncio.Queue(**({"loop": self.loop} if sys.version_info[:2] < (3, 10) else {}))
-        self.logic = logic.Logic(config, self.enqueue)
-
-    def handle_hup(self, signum, frame):
-        '''Handle the SIGHUP signal'''
+        # One queue per worker; items of the same interface/peer always go to the same queue to keep their order (within the same priority)
+        self.queues = [ asyncio.PriorityQueue(maxsize=config.queue_size, **({"loop": self.loop} if sys.version_info[:2] < (3, 10) else {}))
+                        for i in range(config.queue_workers) ]
+        self.sequence = itertools.count() # keeps the order of items of the same priority
+        self.logic = logic.Logic(config, self.enqueue, data=data)
+        self.busy_workers = 0
+        self.watcher = None
+        self.control = None
+        self.queue_stats = self.logic.data.stats.setdefault('queue', { 'depth': 0, 'processed': 0, 'wait-total': 0.0, 'wait-max': 0.0 })
+
+    def handle_hup(self):
+        '''Handle the SIGHUP signal (called within the event loop)'''
         logger.info('Signal "SIGHUP" received; reloading config')
-        self.logic.initialize_data()
+        try:
+            self.logic.reload_data()
+        except Exception as e:
+            logger.error('Reloading config failed: [{0}]'.format(e))
+
+    def handle_term(self):
+        '''Handle the SIGTERM signal (called within the event loop); terminates so that the state can be saved'''
+        logger.info('Signal "SIGTERM" received; terminating')
+        raise SystemExit(0)
+
+    def handle_config_change(self, paths):
+        '''Apply changes of the config files reported by the watcher (None if all files need to be checked)'''
+        logger.info('Config file(s) changed: {0}'.format('unknown' if paths is None else ', '.join(sorted(paths))))
+        self.logic.reload_data(paths)
+
+    def start_watcher(self):
+        '''Starts watching the config files for changes (if possible)'''
+        data = self.logic.data
+        try:
+            self.watcher = watcher.Watcher(self.loop, self.handle_config_change, debounce=self.config.watch_debounce)
+            self.watcher.watch(data.wgcfg.configpath, suffix='.conf')
+            if data.configfile:
+                self.watcher.watch(os.path.dirname(os.path.abspath(data.configfile)), names=[os.path.basename(data.configfile)])
+        except (OSError, AttributeError) as e:
+            logger.warning('Cannot watch config files [{0}]; send SIGHUP after changes instead'.format(e))
+            if self.watcher is not None:
+                self.watcher.close()
+                self.watcher = None
 
     def handle_exception(self, loop, context):
         '''Handler for exceptions in coroutines'''
@@ -45,67 +88,138 @@ class EventProcessor():
             self.loop.set_exception_handler(self.handle_exception)
             self.loop.run_until_complete(self.run_async())            
         finally:
-            for task in asyncio.Task.all_tasks():
+            if self.logic.cycle > 0: # otherwise the state is still the one restored
+                self.logic.save_state()
+            for task in asyncio.all_tasks(self.loop):
                 task.cancel()
             self.loop.run_until_complete(self.loop.shutdown_asyncgens())
             self.loop.close()
 
-    async def handle_message(self, reader, writer):
-        '''Process incoming messages/commands'''
-        data = await reader.read(100)
-        message = data.decode()
-        message = message.strip()
-        addr = writer.get_extra_info('peername')
-        logger.info(f'Received {message!r} from {addr!r}')
-        if message == 'quit':
-            raise KeyboardInterrupt
-        #logger.debug(f'Sending: {message!r}')
-        #writer.write(data)
-        #await writer.drain()
-        writer.close()
+    async def handle_control(self, message):
+        '''Answers a request received via the control socket; queries are answered from the data in memory, commands jump the event queue'''
+        command = message.get('command')
+        data = self.logic.data
+        interface, peer = message.get('interface'), message.get('peer')
+        if command in ['peer', 'recheck', 'resolve']:
+            if not (isinstance(interface, str) and isinstance(peer, str)):
+                return { 'ok': False, 'error': 'interface and peer required' }
+            peerdata = data.get(interface, peer, None)
+            if not peerdata:
+                return { 'ok': False, 'error': 'unknown peer [{0}:{1}]'.format(interface, peer) }
+        if command == 'peer':
+            return { 'ok': True, 'interface': interface, 'peer': peer, 'data': { k: v for k, v in peerdata.items() if k not in SECRET_FIELDS } }
+        elif command == 'down':
+            peers = []
+            for i, interfacedata, p, pd in data.peeriterator():
+                status = pd.get('status') or ''
+                if status.startswith('down') and ((interface is None) or (i == interface)):
+                    peers.append({ 'interface': i, 'peer': p, 'status': status, 'cycle-counter': pd.get('cycle-counter'),
+                                   'config_endpoint': pd.get('config_endpoint'), 'endpoint': pd.get('endpoint') })
+            return { 'ok': True, 'peers': peers }
+        elif command == 'stats':
+            return { 'ok': True, 'cycle': self.logic.cycle, 'degraded': len(self.logic.degraded), 'awake': len(self.logic.awake),
+                     'sleeping': len(self.logic.sleeping), 'stats': data.stats }
+        elif command in ['recheck', 'resolve']:
+            if command == 'recheck':
+                item = ('recheck_peer', { 'interface': interface, 'peer': peer })
+            elif peerdata.get('config_endpoint') is None:
+                return { 'ok': False, 'error': 'no endpoint configured for peer [{0}:{1}]'.format(interface, peer) }
+            else:
+                item = ('update_peer', { 'interface': interface, 'peer': peer, 'config_endpoint': peerdata.get('config_endpoint'),
+                                         'endpoint': peerdata.get('endpoint') or '', 'force': True })
+            try:
+                await asyncio.wait_for(self.enqueue(*item, priority=PRIORITY_HIGH), 1)
+            except asyncio.TimeoutError:
+                return { 'ok': False, 'error': 'event queue full' }
+            logger.info('Control request [{0}] for [{1}:{2}] queued'.format(command, interface, peer))
+            return { 'ok': True, 'queued': True }
+        return { 'ok': False, 'error': 'unknown command [{0}]'.format(command) }
+
+    async def start_control(self):
+        '''Starts the control endpoint (if possible)'''
+        self.control = control.ControlServer(self.config.control_socket, self.handle_control)
+        try:
+            await self.control.start()
+        except OSError as e:
+            logger.warning('Cannot listen on control socket [{0}]: [{1}]'.format(self.config.control_socket, e))
+            self.control = None
+            return
+        self.logic.data.stats['control'] = self.control.stats
 
     async def run_periodically(self, cycle_time):
-        '''Schedules tasks periodically each "cycle_time" (interval in seconds)'''
+        '''Schedules tasks periodically each "cycle_time" (interval in seconds; shorter while peers are degraded)'''
+        degraded = False
         while True:
-            start = time.time()
+            start = clock.monotonic()
             await self.logic.do_periodically()
-            remaining_time = cycle_time - (time.time() - start)
+            self.logic.data.stats['cycle-duration'] = clock.monotonic() - start
+            self.logic.data.stats['cycles'] = self.logic.data.stats.get('cycles', 0) + 1
+            if self.queue_stats['processed'] > 0:
+                logger.debug('Event queue: depth {depth}, {processed} processed, average wait {average:.3f}s, maximum wait {max:.3f}s'.format(
+                             depth=self.queue_stats['depth'], processed=self.queue_stats['processed'],
+                             average=self.queue_stats['wait-total'] / self.queue_stats['processed'], max=self.queue_stats['wait-max']))
+            if self.logic.is_degraded() != degraded:
+                degraded = not degraded
+                logger.info('Polling every {0}s since {1}'.format(self.config.cycle_time_degraded if degraded else cycle_time,
+                            'peers are degraded' if degraded else 'all peers are fine'))
+            interval = self.config.cycle_time_degraded if degraded else cycle_time
+            remaining_time = interval - (clock.monotonic() - start)
             if remaining_time <= 0:
                 logger.warning('Periodic tasks took longer than the cycle time; increase cycle time')
-            await asyncio.sleep(remaining_time)
+            await clock.sleep(remaining_time)
 
-    async def enqueue(self, command, data):
-        '''Enqueues an item in the event queue'''
-        await self.queue.put({'command': command, 'data': data})
+    async def enqueue(self, command, data, priority=PRIORITY_NORMAL):
+        '''Enqueues an item in the event queue (waits if the queue is full); items of higher priority are processed first'''
+        key = (data.get('interface'), data.get('peer'))
+        queue = self.queues[hash(key) % len(self.queues)]
+        await queue.put((priority, next(self.sequence), {'command': command, 'data': data, 'enqueued': clock.monotonic()}))
+        self.queue_stats['depth'] = sum(q.qsize() for q in self.queues)
 
-    async def serve_queue(self):
-        '''Serve the event queue asynchronously'''
+    async def serve_queue(self, queue):
+        '''Serve an event queue asynchronously (one worker per queue)'''
         while True:
-            item = await self.queue.get()
-            await self.logic.process_queue(item)
+            priority, sequence, item = await queue.get()
+            wait = clock.monotonic() - item['enqueued']
+            self.queue_stats['wait-total'] += wait
+            self.queue_stats['wait-max'] = max(self.queue_stats['wait-max'], wait)
+            self.busy_workers += 1
+            try:
+                await self.logic.process_queue(item)
+            except Exception as e:
+                logger.error('Exception when processing event [{0}]: [{1}]'.format(item.get('command'), e))
+            finally:
+                self.busy_workers -= 1
+            self.queue_stats['processed'] += 1
+            self.queue_stats['depth'] = sum(q.qsize() for q in self.queues)
+            if (self.busy_workers == 0) and (self.queue_stats['depth'] == 0): # queue drained; apply collected changes in one go
+                await self.logic.queue_drained()
 
     async def run_async(self):
         '''Asynchronously executed code'''
+        # Reload config on SIGHUP
+        self.loop.add_signal_handler(signal.SIGHUP, self.handle_hup)
+        self.loop.add_signal_handler(signal.SIGTERM, self.handle_term)
+        if self.config.watch_config:
+            self.start_watcher()
         # Periodic tasks
         cycle_time = self.config.cycle_time
         task_periodic = asyncio.ensure_future(self.run_periodically(cycle_time))
-        # Work queue
-        task_queue =  asyncio.ensure_future(self.serve_queue())
-        # Listener for receiving commands
-        #THIS IS WORKING BUT CURRENTLY NOT NEEDED
-        #server = await asyncio.start_server(self.handle_message, '127.0.0.1', 8888)    
-        #addr = server.sockets[0].getsockname()
-        #print(f'Serving on {addr}')
-        #task_server = asyncio.ensure_future(server.serve_forever())
-        task_server = asyncio.ensure_future(asyncio.sleep(1)) # TEMPORARY REPLACEMENT
+        # Work queues
+        tasks_queue = [ asyncio.ensure_future(self.serve_queue(queue)) for queue in self.queues ]
+        # Listener for queries and commands
+        if self.config.control_socket:
+            await self.start_control()
         # Wait for all tasks to finish
-        await asyncio.gather(task_periodic, task_queue, task_server)
+        try:
+            await asyncio.gather(task_periodic, *tasks_queue)
+        finally:
+            if self.control is not None:
+                await self.control.stop()
 
 
 def run(config):
     '''Creates an instance and runs it'''
     evt = EventProcessor(config)
-    signal.signal(signal.SIGHUP, evt.handle_hup)
     evt.eventloop()
 
 
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Fixed-size history of recent samples of each peer for calculating throughput rates"""
+
+import array
+import collections.abc
+import logging
+
+from . import peerrecord
+
+
+logger = logging.getLogger(__name__);
+
+FIELDS = 4 # values per sample: timestamp, received bytes, transmitted bytes, latest handshake
+
+
+class PeerHistory():
+    '''Ring buffer of the most recent samples of a peer (preallocated, so its size does not change)'''
+    __slots__ = ('samples', 'next', 'count')
+
+    def __init__(self, capacity):
+        '''Constructor'''
+        self.samples = array.array('d', bytes(8 * FIELDS * capacity)) # doubles are exact for counters up to 2^53
+        self.next = 0 # index of the sample to be overwritten next
+        self.count = 0 # number of valid samples
+
+    @property
+    def capacity(self):
+        return len(self.samples) // FIELDS
+
+    def add(self, timestamp, transfer_rx, transfer_tx, latest_handshake):
+        '''Adds a sample (replacing the oldest one if the buffer is full)'''
+        samples = self.samples
+        offset = self.next * FIELDS
+        samples[offset] = timestamp
+        samples[offset + 1] = transfer_rx
+        samples[offset + 2] = transfer_tx
+        samples[offset + 3] = latest_handshake
+        capacity = len(samples) // FIELDS
+        self.next = (self.next + 1) % capacity
+        if self.count < capacity:
+            self.count += 1
+
+    def get_latest_timestamp(self):
+        '''Returns the timestamp of the most recent sample (None if there is none)'''
+        if self.count == 0:
+            return None
+        return self.samples[((self.next - 1) % self.capacity) * FIELDS]
+
+    def get_samples(self, number=None):
+        '''Returns the most recent samples (all if number is not given) as list of tuples, the oldest first'''
+        count = self.count if number is None else min(number, self.count)
+        capacity = self.capacity
+        result = []
+        for i in range(self.next - count, self.next):
+            offset = (i % capacity) * FIELDS
+            result.append(tuple(self.samples[offset:offset + FIELDS]))
+        return result
+
+    def get_rates(self, number=2):
+        '''Returns the receive and transmit rates (bytes per second) over the given number of most recent samples (None if not enough samples)'''
+        if (number == 2) and (self.count >= 2): # most common case: rates since the previous sample
+            samples, capacity = self.samples, len(self.samples) // FIELDS
+            current, previous = ((self.next - 1) % capacity) * FIELDS, ((self.next - 2) % capacity) * FIELDS
+            duration = samples[current] - samples[previous]
+            if duration <= 0:
+                return None
+            received, transmitted = samples[current + 1], samples[current + 2]
+            if received >= samples[previous + 1]:
+                received -= samples[previous + 1]
+            if transmitted >= samples[previous + 2]:
+                transmitted -= samples[previous + 2]
+            return received / duration, transmitted / duration
+        samples = self.get_samples(number)
+        if len(samples) < 2:
+            return None
+        duration = samples[-1][0] - samples[0][0]
+        if duration <= 0:
+            return None
+        received = transmitted = 0
+        for previous, current in zip(samples, samples[1:]):
+            # A counter lower than before has been reset (e.g. interface restarted); then it counts from zero
+            received += current[1] - previous[1] if current[1] >= previous[1] else current[1]
+            transmitted += current[2] - previous[2] if current[2] >= previous[2] else current[2]
+        return received / duration, transmitted / duration
+
+
+class History():
+    '''Histories of all peers; peers that disappear are dropped so that memory stays bounded'''
+
+    def __init__(self, capacity=10, rate_samples=2):
+        '''Constructor ("rate_samples" is the number of samples the rates are calculated over)'''
+        self.capacity = max(2, capacity)
+        self.rate_samples = max(2, min(rate_samples, self.capacity))
+        self.peers = dict() # interface -> peer -> PeerHistory
+
+    def record(self, data):
+        '''Adds a sample for each peer of the given data and stores the rates in the peer data as "rate-rx" and "rate-tx"'''
+        peers = dict()
+        for interface, interfacedata in data.items():
+            if not isinstance(interfacedata, collections.abc.Mapping):
+                continue
+            known = self.peers.get(interface, dict())
+            kept = peers[interface] = dict()
+            for peer, peerdata in interfacedata.get('peers', dict()).items():
+                try: # read the slots of the record directly (the mapping interface is much slower)
+                    timestamp, transfer_rx, transfer_tx, latest_handshake = peerdata.timestamp, peerdata.transfer_rx, peerdata.transfer_tx, peerdata.latest_handshake
+                except AttributeError: # attribute not set or no record
+                    timestamp, transfer_rx, transfer_tx, latest_handshake = (peerdata.get(attr) for attr in ['timestamp', 'transfer-rx', 'transfer-tx', 'latest-handshake'])
+                if (timestamp is None) or (transfer_rx is None) or (transfer_tx is None): # no status of this peer
+                    continue
+                peerhistory = known.get(peer)
+                if peerhistory is None:
+                    peerhistory = PeerHistory(self.capacity)
+                kept[peer] = peerhistory
+                if timestamp != peerhistory.get_latest_timestamp(): # otherwise the status has not been updated
+                    peerhistory.add(timestamp, transfer_rx, transfer_tx, latest_handshake or 0)
+                rates = peerhistory.get_rates(self.rate_samples)
+                if rates is None:
+                    rates = (None, None)
+                if type(peerdata) is peerrecord.PeerRecord:
+                    peerdata.rate_rx, peerdata.rate_tx = rates
+                else:
+                    peerdata['rate-rx'], peerdata['rate-tx'] = rates
+        self.peers = peers
+
+    def get(self, interface, peer):
+        '''Returns the history of the given peer (None if there is none)'''
+        return self.peers.get(interface, dict()).get(peer)
+
+    def get_rates(self, interface, peer, number=None):
+        '''Returns the receive and transmit rates of the given peer over the given number of samples (default: as configured)'''
+        peerhistory = self.get(interface, peer)
+        if peerhistory is None:
+            return None
+        return peerhistory.get_rates(self.rate_samples if number is None else number)
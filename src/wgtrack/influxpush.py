@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""Sends the status in the InfluxDB wire protocol directly to Telegraf (socket listener) or to the InfluxDB write API"""
+
+import asyncio
+import base64
+import collections
+import gzip
+import logging
+import urllib.parse
+
+
+logger = logging.getLogger(__name__);
+
+DEFAULT_PORTS = { 'udp': 8094, 'tcp': 8094, 'http': 8086, 'https': 8086 }
+
+
+class PushError(Exception):
+    '''Error when sending data (the data may be sent again later)'''
+
+
+class ConnectionClosedError(PushError):
+    '''The connection has been closed before a response arrived (e.g. a kept-alive connection closed by the server while idle)'''
+
+
+def split_chunks(payload, size):
+    '''Splits the given lines (bytes) at line ends into chunks of at most the given size (longer lines form a chunk of their own)'''
+    chunks = []
+    start = 0
+    while start < len(payload):
+        end = start + size
+        if end < len(payload):
+            split = payload.rfind(b'\n', start, end)
+            if split < 0: # line longer than the chunk size
+                split = payload.find(b'\n', end)
+                if split < 0:
+                    split = len(payload) - 1
+            end = split + 1
+        chunks.append(payload[start:end])
+        start = end
+    return chunks
+
+
+class InfluxPusher():
+    '''Sends lines in batches over a persistent connection; chunks that could not be sent are kept in a bounded buffer and retried'''
+
+    def __init__(self, url, batch_size=None, buffer_size=16777216, timeout=5, compress=False, token=None):
+        '''Constructor; the URL specifies the transport, e.g. "udp://127.0.0.1:8094", "tcp://127.0.0.1:8094", or "http://127.0.0.1:8086/write?db=telegraf"'''
+        self.url = urllib.parse.urlsplit(url)
+        self.transport = self.url.scheme
+        if self.transport not in DEFAULT_PORTS:
+            raise ValueError('Unsupported transport [{0}] in URL [{1}]'.format(self.transport, url))
+        self.host = self.url.hostname or '127.0.0.1'
+        self.port = self.url.port or DEFAULT_PORTS[self.transport]
+        if batch_size is None:
+            batch_size = 1400 if self.transport == 'udp' else 1048576 # stay below the usual MTU for datagrams
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size # maximum number of bytes kept for retrying
+        self.timeout = timeout
+        self.compress = compress and self.transport in ['http', 'https'] # only the write API accepts compressed requests
+        self.headers = { 'Host': self.url.netloc, 'Content-Type': 'text/plain; charset=utf-8' }
+        if token is not None: # InfluxDB 2.x
+            self.headers['Authorization'] = 'Token ' + token
+        elif self.url.username is not None: # InfluxDB 1.x
+            credentials = '{0}:{1}'.format(urllib.parse.unquote(self.url.username), urllib.parse.unquote(self.url.password or ''))
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        if self.compress:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.target = (self.url.path or '/write') + ('?' + self.url.query if self.url.query else '')
+        self.buffer = collections.deque() # chunks not sent yet
+        self.buffered = 0 # number of bytes in the buffer
+        self.reader = None
+        self.writer = None
+        self.datagram_transport = None
+        self.requests_sent = 0 # number of requests sent over the current connection
+        self.stats = { 'chunks-sent': 0, 'bytes-sent': 0, 'chunks-dropped': 0, 'failures': 0 }
+
+    def enqueue(self, lines):
+        '''Adds the given lines (string) to the buffer; the oldest chunks are dropped if the buffer gets too large'''
+        for chunk in split_chunks(lines.encode('utf-8'), self.batch_size):
+            self.buffer.append(chunk)
+            self.buffered += len(chunk)
+        dropped = 0
+        while (self.buffered > self.buffer_size) and (len(self.buffer) > 1):
+            self.buffered -= len(self.buffer.popleft())
+            dropped += 1
+        if dropped > 0:
+            self.stats['chunks-dropped'] += dropped
+            logger.warning('Dropped {0} unsent chunk(s) of [{1}] since the buffer is full'.format(dropped, self.url.geturl()))
+
+    async def push(self, lines):
+        '''Sends the given lines together with lines still buffered from previous attempts'''
+        self.enqueue(lines)
+        await self.flush()
+
+    async def flush(self):
+        '''Sends the buffered chunks in order; stops at the first failure (the remaining chunks are retried next time)'''
+        while self.buffer:
+            chunk = self.buffer[0]
+            try:
+                await asyncio.wait_for(self.send(chunk), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, PushError) as e:
+                self.stats['failures'] += 1
+                logger.warning('Sending status to [{0}] failed, keeping {1} chunk(s) for retrying: {2}'.format(self.url.geturl(), len(self.buffer), e or type(e).__name__))
+                await self.close()
+                return
+            self.buffer.popleft()
+            self.buffered -= len(chunk)
+            self.stats['chunks-sent'] += 1
+            self.stats['bytes-sent'] += len(chunk)
+
+    async def connect(self):
+        '''Opens the connection if it is not open'''
+        if self.transport == 'udp':
+            if self.datagram_transport is None:
+                loop = asyncio.get_running_loop()
+                self.datagram_transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(self.host, self.port))
+        elif (self.writer is None) or self.writer.is_closing():
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=(self.transport == 'https') or None)
+            self.requests_sent = 0
+
+    async def close(self):
+        '''Closes the connection'''
+        if self.datagram_transport is not None:
+            self.datagram_transport.close()
+            self.datagram_transport = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader, self.writer = None, None
+
+    async def send(self, chunk):
+        '''Sends a chunk using the configured transport'''
+        await self.connect()
+        if self.transport == 'udp':
+            self.datagram_transport.sendto(chunk)
+        elif self.transport == 'tcp':
+            self.writer.write(chunk)
+            await self.writer.drain()
+        else:
+            reused = self.requests_sent > 0
+            try:
+                await self.send_http(chunk)
+            except ConnectionClosedError:
+                if not reused:
+                    raise
+                # The server closes idle connections (e.g. Telegraf after 10s); the request has not been processed, so send it again
+                logger.debug('Connection to [{0}] closed while idle; reconnecting'.format(self.url.geturl()))
+                await self.close()
+                await self.connect()
+                await self.send_http(chunk)
+
+    async def send_http(self, chunk):
+        '''Sends a chunk to the write API (the connection is kept alive)'''
+        body = gzip.compress(chunk, compresslevel=6) if self.compress else chunk
+        headers = { **self.headers, 'Content-Length': str(len(body)) }
+        head = 'POST {0} HTTP/1.1\r\n'.format(self.target) + ''.join('{0}: {1}\r\n'.format(k, v) for k, v in headers.items()) + '\r\n'
+        try:
+            self.writer.write(head.encode('latin-1') + body)
+            await self.writer.drain()
+            # Read the response
+            statusline = (await self.reader.readuntil(b'\r\n')).decode('latin-1')
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            raise ConnectionClosedError('connection closed without response') from None
+        except ConnectionError as e:
+            raise ConnectionClosedError(str(e) or type(e).__name__) from None
+        self.requests_sent += 1
+        response_headers = dict()
+        while True:
+            line = (await self.reader.readuntil(b'\r\n')).decode('latin-1')
+            if line == '\r\n':
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = b''
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                content += (await self.reader.readexactly(size + 2))[:-2]
+                if size == 0:
+                    break
+        else:
+            content = await self.reader.readexactly(int(response_headers.get('content-length', 0)))
+        if response_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        status = int(statusline.split()[1])
+        if status in [429] or status >= 500: # try again later
+            raise PushError('HTTP status {0}: {1}'.format(status, content[:200].decode('utf-8', 'replace')))
+        if status >= 300: # the data is not accepted; sending it again would not help
+            logger.error('Status rejected by [{0}] with HTTP status {1}: {2}'.format(self.url.geturl(), status, content[:200].decode('utf-8', 'replace')))
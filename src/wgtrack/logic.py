@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import heapq
 import logging
 import socket
 
+from . import clock
 from . import datakeeper as dk
 from . import output
+from . import pinger
+from . import resolver
 
 
 logger = logging.getLogger(__name__)
@@ -14,24 +18,49 @@ logger = logging.getLogger(__name__)
 class Logic():
     '''Class that contains the business logic of this application'''
 
-    def __init__(self, config, func_enqueue):
-        '''Constructor'''
+    def __init__(self, config, func_enqueue, data=None):
+        '''Constructor (a DataKeeper instance may be provided instead of creating one)'''
         self.config = config
         self.func_enqueue = func_enqueue
-        self.data = dk.DataKeeper(config)
+        self.data = dk.DataKeeper(config) if data is None else data
+        self.pinger = pinger.Pinger(use_socket=(config.ping_backend == 'socket'))
+        self.resolver = resolver.Resolver(nameservers=config.dns_nameservers, use_builtin=(config.dns_backend == 'builtin'), timeout=config.dns_timeout,
+                                          default_ttl=config.dns_default_ttl, negative_ttl=config.dns_negative_ttl)
+        self.data.stats['dns'] = self.resolver.stats
+        self.data.stats['pings-sent'] = 0
+        self.data.stats['pings-saved'] = 0 # pings not needed since the peer has just sent data
+        # Scheduling of peers
+        self.cycle = 0 # number of the current cycle; cycles are counted in wall time (one per "cycle_time")
+        self.next_cycle = None # time at which the next cycle starts
+        self.degraded = set() # peers (as tuples of interface and peer) that are down or not checked yet
+        self.full_scan = True # look at all peers in the next cycle
+        self.awake = set() # peers (as tuples of interface and peer) to be looked at each cycle
+        self.sleeping = dict() # peers waiting for a timer (or for a handshake change) -> cycle at which they are due
+        self.schedule = [] # heap of tuples (due cycle, interface, peer)
+        # Continue with the state of a previous run
+        self.state_saved = None # time at which the state has been saved the last time
+        if config.state_file:
+            self.data.restore_state(config.state_file, config.state_max_age, config.cycle_time, self.resolver.cache)
 
     def initialize_data(self):
         '''Reload the config and status'''
         self.data.initialize()
+        self.full_scan = True
+
+    def reload_data(self, paths=None):
+        '''Applies changes of the config files (all or the given ones) while keeping the state of unchanged peers'''
+        changed = self.data.reload(paths)
+        self.awake.update(changed) # look at the affected peers in the next cycle
+
+    def save_state(self):
+        '''Saves the tracking state of the peers so that a later run can continue with it'''
+        if self.config.state_file:
+            self.state_saved = clock.monotonic()
+            self.data.save_state(self.config.state_file, self.cycle, self.resolver.cache)
 
     async def ping(self, destination, interface, ping6=False):
-        '''Asynchronously execute the ping command to check reachability'''
-        command = 'ping'
-        if ping6 or (':' in destination):
-            command = 'ping6'
-        proc = await asyncio.create_subprocess_exec(command, '-q', '-c', '1', '-w', '1', '-W', '1', '-I', interface, destination, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await proc.communicate()
-        return proc.returncode
+        '''Asynchronously check reachability (returns 0 on success like the ping command)'''
+        return await self.pinger.ping(destination, interface, ping6)
 
     def is_hostname(self, peername):
         '''Checks whether the provided peer is defined by hostname (in contrast to IP address)'''
@@ -49,11 +78,101 @@ class Logic():
             return False
         return self.is_hostname(endpoint.rpartition(':')[0]) # rpartition also works with IPv6
 
+    def has_received_traffic(self, peerdata):
+        '''Checks whether data has been received from the peer since this was last checked (proving that the link works)'''
+        current = (peerdata.get('transfer-rx'), peerdata.get('transfer-tx'), peerdata.get('latest-handshake'))
+        previous = peerdata.get('transfer-previous')
+        peerdata['transfer-previous'] = current
+        if (previous is None) or (current[0] is None) or (previous[0] is None):
+            return False
+        if (current[0] < previous[0]) or (current[1] < previous[1]): # counters have been reset, e.g. peer re-added
+            return False
+        return current[0] > previous[0]
+
+    def peers_to_visit(self):
+        '''Returns the peers that need to be looked at in the current cycle (as a generator)'''
+        if self.full_scan:
+            self.full_scan = False
+            self.awake, self.sleeping, self.schedule, self.degraded = set(), dict(), [], set()
+            self.data.take_handshake_changes()
+            yield from self.data.peeriterator()
+            return
+        keys = self.awake | self.data.take_handshake_changes()
+        while self.schedule and (self.schedule[0][0] <= self.cycle):
+            due, interface, peer = heapq.heappop(self.schedule)
+            if self.sleeping.get((interface, peer)) == due: # ignore outdated entries
+                keys.add((interface, peer))
+        for interface, peer in keys:
+            peerdata = self.data.get(interface, peer, None)
+            if not peerdata: # peer vanished
+                self.awake.discard((interface, peer))
+                self.sleeping.pop((interface, peer), None)
+                self.degraded.discard((interface, peer))
+                continue
+            yield interface, self.data.get(interface, None, None), peer, peerdata
+
+    def cycles_until_due(self, peerdata):
+        '''Returns the number of cycles until the peer needs to be looked at again (None: only once its handshake changes)'''
+        if peerdata.get('handshake-status', 'failed') not in ['none', 'failed']:
+            return 1
+        status = peerdata.get('status', 'undefined')
+        cycle_counter = peerdata.get('cycle-counter', 0) # value seen when looking at the peer in the next cycle
+        if status == 'down:waiting':
+            return max(1, self.config.cycles_wait - cycle_counter + 1)
+        elif status == 'down:checking':
+            cycles_checkperiod = self.config.cycles_checkperiod
+            due_counter = min(-(-cycle_counter // cycles_checkperiod) * cycles_checkperiod, max(cycle_counter, self.config.cycles_checking))
+            return due_counter - cycle_counter + 1
+        elif status == 'down:backingoff':
+            return max(1, peerdata['backingoff-limit'] - cycle_counter + 1)
+        elif status == 'down:slowchecking':
+            return max(1, self.config.cycles_slowcheckingperiod - cycle_counter + 1)
+        elif status in ['down', 'disabled']:
+            return None
+        return 1
+
+    def schedule_peer(self, interface, peer, peerdata):
+        '''Determines when the peer needs to be looked at again'''
+        key = (interface, peer)
+        status = peerdata.get('status', 'undefined')
+        if status.startswith('down:') or (status == 'undefined'):
+            self.degraded.add(key)
+        else:
+            self.degraded.discard(key)
+        cycles = self.cycles_until_due(peerdata)
+        if cycles == 1:
+            self.awake.add(key)
+            self.sleeping.pop(key, None)
+        else:
+            self.awake.discard(key)
+            due = None if cycles is None else self.cycle + cycles
+            self.sleeping[key] = due
+            if due is not None:
+                heapq.heappush(self.schedule, (due, interface, peer))
+
+    def is_degraded(self):
+        '''Returns whether any peer is down (or not checked yet) so that the status shall be polled more often'''
+        return len(self.degraded) > 0
+
+    def advance_cycle(self):
+        '''Advances the cycle number according to the wall time passed; returns the number of cycles started'''
+        now = clock.monotonic()
+        cycle_time = self.config.cycle_time
+        tolerance = min(cycle_time, self.config.cycle_time_degraded) / 2 # polling may be slightly early
+        if self.next_cycle is None:
+            self.next_cycle = now
+        cycles = 0
+        while now >= self.next_cycle - tolerance:
+            cycles += 1
+            self.next_cycle += cycle_time
+        self.cycle += cycles
+        return cycles
+
     async def do_periodically(self):
         '''Tasks to be executed periodically each cycle (called by scheduler coroutine)'''
         logger.debug('Executing periodic tasks')
         # Updates the WireGuard status information
-        self.data.update_status()
+        self.awake.update(await self.data.update_status_async()) # peers of new interfaces are looked at in this cycle
         # Get config attributes
         cycles_wait = self.config.cycles_wait
         cycles_checking = self.config.cycles_checking
@@ -61,9 +180,17 @@ class Logic():
         cycles_slowcheckingperiod = self.config.cycles_slowcheckingperiod
         ping_interval = self.config.ping_interval
         ping_failafternum = self.config.ping_failafternum
-        # Iterate through all peers of all interfaces and determine new status
+        # Iterate through the peers that need attention and determine new status
+        self.advance_cycle()
+        visited = []
         ping_plan = []
-        for interface, interfacedata, peer, peerdata in self.data.peeriterator():
+        for interface, interfacedata, peer, peerdata in self.peers_to_visit():
+            visited.append((interface, peer, peerdata))
+            synced = peerdata.get('cycle-synced')
+            advanced = (synced is None) or (synced < self.cycle) # False if polled again within the same cycle
+            if (synced is not None) and advanced: # count the cycles in which the peer has not been looked at
+                peerdata['cycle-counter'] = peerdata.get('cycle-counter', 0) + (self.cycle - synced - 1)
+            peerdata['cycle-synced'] = self.cycle
             status = peerdata.get('status', 'undefined')
             cycle_counter = peerdata.get('cycle-counter', 0)
             #print(interface, 'Status', status, cycle_counter)
@@ -73,7 +200,7 @@ class Logic():
             if peerdata.get('handshake-status', 'failed') not in ['none', 'failed']:
                 if peerdata.get('ping-address') is None:
                     peerdata['ping-address'] = peerdata['allowed-ips'][0].partition('/')[0]
-                if ping_interval > 0:
+                if (ping_interval > 0) and advanced: # pinged at most once per cycle so that faster polling does not change the thresholds
                     if cycle_counter % ping_interval == 0:
                         next = 'ping'                
                 if (status == 'undefined') and (next == 'unchanged'):
@@ -86,6 +213,8 @@ class Logic():
                         next = 'disabled'
                     else:
                         next = 'down'
+            elif not advanced: # timers only run once per cycle
+                pass
             elif status == 'down:waiting':
                 if cycle_counter >= cycles_wait:
                     next = 'down:checking'
@@ -113,7 +242,8 @@ class Logic():
             else:
                 logger.critical('Unknown status [{0}]'.format(status))
             # Count cycles
-            peerdata['cycle-counter'] = peerdata.get('cycle-counter', 0) + 1
+            if advanced:
+                peerdata['cycle-counter'] = peerdata.get('cycle-counter', 0) + 1
             # Change state as needed
             if next == 'ping':
                 if status == 'undefined':
@@ -131,8 +261,8 @@ class Logic():
                 logger.info('Changing status of [{interface}:{peer}] to [{next}] after {cycle_counter} cycles'.format(interface=interface, peer=peer, next=next, cycle_counter=cycle_counter))
                 peerdata['cycle-counter'] = 0
                 status = next
-            # Update peer if requested
-            if update_peer:
+            # Update peer if requested (there is nothing to re-resolve if no endpoint is configured)
+            if update_peer and (peerdata.get('config_endpoint') is not None):
                 config_endpoint = peerdata.get('config_endpoint')
                 logger.debug('Requesting to check for update of [{interface}:{peer}], endpoint [{config_endpoint}]'.format(interface=interface, peer=peer, config_endpoint=config_endpoint))
                 await self.func_enqueue('update_peer', { 'interface': interface, 'peer': peer, 'config_endpoint': peerdata.get('config_endpoint'), 'endpoint': peerdata.get('endpoint') })
@@ -140,15 +270,23 @@ class Logic():
             peerdata['status'] = status
         # Check reachability by pinging peers
         if len(ping_plan) > 0:
+            ping_passive = self.config.ping_passive
             ping_tasks = []
             for interface, interfacedata, peer, peerdata in ping_plan:
+                if ping_passive and self.has_received_traffic(peerdata): # peer is alive; no need to ping
+                    ping_tasks.append(None)
+                    continue
                 addr = peerdata['ping-address']
                 ping_tasks.append(asyncio.ensure_future(self.ping(addr, interface)))
-            await asyncio.gather(*ping_tasks)
+            pings = [ ping_task for ping_task in ping_tasks if ping_task is not None ]
+            self.data.stats['pings-sent'] += len(pings)
+            self.data.stats['pings-saved'] += len(ping_tasks) - len(pings)
+            await asyncio.gather(*pings)
             for i, ping_task in enumerate(ping_tasks):
-                if ping_task.result() == 0:
+                if (ping_task is None) or (ping_task.result() == 0):
                     if ping_plan[i][3]['status'] != 'up:ok':
-                        logger.info('Changing status of [{interface}:{peer}] to [up:ok] after successful ping'.format(interface=ping_plan[i][0], peer=ping_plan[i][2]))
+                        logger.info('Changing status of [{interface}:{peer}] to [up:ok] after {event}'.format(interface=ping_plan[i][0], peer=ping_plan[i][2],
+                                    event='successful ping' if ping_task is not None else 'receiving data'))
                         ping_plan[i][3]['status'] = 'up:ok'
                         ping_plan[i][3]['cycle-counter'] = 0
                     ping_plan[i][3]['ping-failcounter'] = 0
@@ -159,12 +297,22 @@ class Logic():
                             logger.info('Changing status of [{interface}:{peer}] to [down:waiting] after failed ping'.format(interface=ping_plan[i][0], peer=ping_plan[i][2]))
                             ping_plan[i][3]['status'] = 'down:waiting'
                         ping_plan[i][3]['cycle-counter'] = 0
+        # Determine when to look at the visited peers again
+        for interface, peer, peerdata in visited:
+            self.schedule_peer(interface, peer, peerdata)
+        self.data.stats['peers-visited'] = len(visited)
+        logger.debug('Looked at {0} peer(s), {1} waiting for a timer; {2} ping(s) sent, {3} saved so far'.format(len(visited), len(self.sleeping),
+                     self.data.stats['pings-sent'], self.data.stats['pings-saved']))
         # Output new status
         await output.output_status(self.config.outputs, self.data)
+        if (self.state_saved is None) or (clock.monotonic() - self.state_saved >= self.config.state_interval):
+            self.save_state()
 
-    def update_peer(self, interface, peer, config_endpoint, endpoint):
-        '''Checks whether peer needs to be updated and does it if needed'''
+    async def update_peer(self, interface, peer, config_endpoint, endpoint, force=False):
+        '''Checks whether peer needs to be updated and does it if needed (with "force", the hostname is resolved anew instead of using the cache)'''
         config_endpoint, _, config_port = config_endpoint.rpartition(':') # rpartition also works with IPv6
+        if force:
+            self.resolver.invalidate(config_endpoint)
         # Endpoint IPv4 has format "1.1.1.1:51712", endpoint IPv6 has format "[2003:db:cf0c:f100:dea6:32ff:fe9a:859d]:51712"; thus split at last colon
         endpoint = endpoint.rpartition(':')[0]
         # Remove leading "[" and trailing "]" in IPv6 case
@@ -173,7 +321,7 @@ class Logic():
         logger.info('Resolving [{0}]'.format(config_endpoint))
         needed_endpoint = None
         try:
-            needed_endpoint = socket.getaddrinfo(config_endpoint, 0)[0][4][0] # get ip address
+            needed_endpoint = await self.resolver.resolve_first(config_endpoint) # get ip address (cached according to TTL)
         except socket.gaierror as e:
             # Something like "socket.gaierror: [Errno -3] Try again" can happen here
             logger.warning('Error resolving interface endpoint [{0}]: {1}'.format(config_endpoint, str(e)))            
@@ -183,10 +331,39 @@ class Logic():
                 needed_endpoint += ':' + config_port
             self.data.set_endpoint(interface, peer, needed_endpoint)
 
+    async def recheck_peer(self, interface, peer):
+        '''Checks the reachability of the peer right away (instead of waiting for its next check); the peer is looked at in the next cycle in any case'''
+        peerdata = self.data.get(interface, peer, None)
+        if not peerdata: # peer vanished
+            return
+        key = (interface, peer)
+        self.awake.add(key)
+        self.sleeping.pop(key, None)
+        address = peerdata.get('ping-address')
+        if (address is None) and peerdata.get('allowed-ips'):
+            address = peerdata['allowed-ips'][0].partition('/')[0]
+        if address is None:
+            return
+        self.data.stats['pings-sent'] += 1
+        if await self.ping(address, interface) == 0:
+            if peerdata.get('status') != 'up:ok':
+                logger.info('Changing status of [{interface}:{peer}] to [up:ok] after successful ping on request'.format(interface=interface, peer=peer))
+                peerdata['status'] = 'up:ok'
+                peerdata['cycle-counter'] = 0
+            peerdata['ping-failcounter'] = 0
+        else:
+            logger.info('Ping of [{interface}:{peer}] on request failed'.format(interface=interface, peer=peer))
+
+    async def queue_drained(self):
+        '''Called when all items of the event queue have been processed'''
+        await self.data.apply_endpoints()
+
     async def process_queue(self, item):
         '''Process an item from the event queue (called by queue listener coroutine)'''
         data = item.get('data', dict())
         if item.get('command') == 'update_peer':
-            self.update_peer(data['interface'], data['peer'], data['config_endpoint'], data['endpoint'])
+            await self.update_peer(data['interface'], data['peer'], data['config_endpoint'], data['endpoint'], data.get('force', False))
+        elif item.get('command') == 'recheck_peer':
+            await self.recheck_peer(data['interface'], data['peer'])
         else:
             logger.critical('Unknown command in event [{0}]'.format(item.get('command')))
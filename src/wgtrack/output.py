@@ -1,55 +1,232 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import copy
 import logging
-import time
 
 from . import atomicwrite
+from . import clock
+from . import influxpush
+from . import prometheus
 
 
 logger = logging.getLogger(__name__)
 
+exporters = dict() # output name -> exporter serving the status (kept across cycles)
+backends = dict() # output name -> registered backend
+entry_points_loaded = False
+running = dict() # output name -> task of an output still running
 
-async def output_status_influx(config, data):
-    '''Outputs the status as InfluxDB wire protocol'''
+
+class OutputBackend():
+    '''Output backend registered by name; blocking backends are run in a thread pool'''
+
+    def __init__(self, name, func, blocking=False):
+        '''Constructor ("func" is called with the config section of the output and the data)'''
+        self.name = name
+        self.func = func
+        self.blocking = blocking
+
+
+class DataSnapshot():
+    '''Copy of the status for backends running in a thread (the data is changed by the next cycle meanwhile)'''
+
+    def __init__(self, data):
+        '''Constructor'''
+        self.peers = [ (interface, dict(interfacedata), peer, dict(peerdata)) for interface, interfacedata, peer, peerdata in data.peeriterator() ]
+        self.stats = copy.deepcopy(getattr(data, 'stats', dict()))
+
+    def peeriterator(self):
+        '''Returns the peer data (as a generator)'''
+        yield from self.peers
+
+
+def register(name, blocking=False):
+    '''Decorator for registering an output backend under the given name'''
+    def decorator(func):
+        backends[name] = OutputBackend(name, func, blocking)
+        return func
+    return decorator
+
+def load_entry_points():
+    '''Registers the output backends provided by other packages via the "wgtrack.outputs" entry point group'''
+    try:
+        import importlib.metadata
+        try:
+            entry_points = importlib.metadata.entry_points(group='wgtrack.outputs')
+        except TypeError: # Python < 3.10
+            entry_points = importlib.metadata.entry_points().get('wgtrack.outputs', [])
+    except ImportError: # Python < 3.8
+        return
+    for entry_point in entry_points:
+        if entry_point.name in backends:
+            logger.warning('Output [{0}] of [{1}] ignored since an output of this name exists already'.format(entry_point.name, entry_point.value))
+            continue
+        try:
+            backend = entry_point.load()
+        except Exception as e:
+            logger.error('Loading output [{0}] from [{1}] failed: {2}'.format(entry_point.name, entry_point.value, e))
+            continue
+        if not isinstance(backend, OutputBackend): # function; blocking unless it is a coroutine function or declares otherwise
+            backend = OutputBackend(entry_point.name, backend, getattr(backend, 'blocking', not asyncio.iscoroutinefunction(backend)))
+        backends[entry_point.name] = backend
+        logger.debug('Registered output [{0}] from [{1}]'.format(entry_point.name, entry_point.value))
+
+
+def sanitize_influx(value):
+    '''Removes any special characters that have meaning in the Influx wire protocol from a field value'''
+    return str(value).replace('=','').replace(',','').replace('"','').replace(' ','')
+
+
+class InfluxRenderer():
+    '''Renders the status as InfluxDB wire protocol; the escaped measurement and tag set of each peer and the status fields are cached'''
     # https://github.com/influxdata/telegraf/blob/master/docs/DATA_FORMATS_INPUT.md
     # https://docs.influxdata.com/influxdb/v1.7/write_protocols/line_protocol_tutorial/
+
+    def __init__(self):
+        '''Constructor'''
+        self.prefixes = dict() # interface -> peer -> measurement and tag set (only peers of the last rendering are kept)
+        self.status_fields = dict() # status -> status fields (status and "is_up")
+        self.timestamp = None # timestamp of the peer rendered last (usually the same for all peers of a cycle)
+        self.timestamp_text = None
+
+    def get_prefix(self, interface, peer):
+        '''Returns the measurement and tag set of the given peer'''
+        peer = peer.replace('=', '\\=') # the equal sign needs to be escaped
+        return 'wgtrack,interface={interface},peer={peer} '.format(interface=interface, peer=peer)
+
+    def get_status_fields(self, status):
+        '''Returns the fields for the given status'''
+        fields = self.status_fields.get(status)
+        if fields is None:
+            fields = '' if status is None else 'status="{0}",'.format(sanitize_influx(status)) # None values are omitted
+            fields += 'is_up=1i' if status == 'up:ok' else 'is_up=0i'
+            if len(self.status_fields) < 100: # statuses are few; just in case
+                self.status_fields[status] = fields
+        return fields
+
+    def render(self, data):
+        '''Renders the lines of all peers (returns a string)'''
+        lines = []
+        append = lines.append
+        status_cache = self.status_fields
+        prefixes = dict()
+        current_interface = None
+        for interface, interfacedata, peer, peerdata in data.peeriterator():
+            if interface != current_interface: # peers are iterated per interface
+                current_interface = interface
+                cached = self.prefixes.get(interface, dict())
+                kept = prefixes.setdefault(interface, dict())
+            prefix = cached.get(peer)
+            if prefix is None:
+                prefix = self.get_prefix(interface, peer)
+            kept[peer] = prefix
+            try: # read the slots of the record directly (the mapping interface is much slower)
+                timestamp, status, transfer_rx, transfer_tx = peerdata.timestamp, peerdata.status, peerdata.transfer_rx, peerdata.transfer_tx
+            except AttributeError: # attribute not set or no record
+                timestamp, status, transfer_rx, transfer_tx = (peerdata.get(attr) for attr in ['timestamp', 'status', 'transfer-rx', 'transfer-tx'])
+            if timestamp is None:
+                timestamp = clock.time()
+            if timestamp != self.timestamp:
+                self.timestamp, self.timestamp_text = timestamp, '{:.0f}'.format(timestamp*1000000000)
+            status_fields = status_cache.get(status)
+            if status_fields is None:
+                status_fields = self.get_status_fields(status)
+            if (type(transfer_rx) is int) and (type(transfer_tx) is int):
+                append('%stransfer_rx=%d,transfer_tx=%d,%s %s\n' % (prefix, transfer_rx, transfer_tx, status_fields, self.timestamp_text))
+            else: # counters missing or not integers
+                readings = [ '{attr}={value}'.format(attr=attr, value=sanitize_influx(value))
+                             for attr, value in [('transfer_rx', transfer_rx), ('transfer_tx', transfer_tx)] if value is not None ]
+                readings.append(status_fields)
+                append('{prefix}{readings} {timestamp}\n'.format(prefix=prefix, readings=','.join(readings), timestamp=self.timestamp_text))
+        self.prefixes = prefixes
+        return ''.join(lines)
+
+
+influx_renderer = InfluxRenderer()
+
+def render_influx(data):
+    '''Renders the status as InfluxDB wire protocol (returns a string)'''
+    return influx_renderer.render(data)
+
+def write_file(filename, content, fsync=False):
+    '''Replaces the given file by the given content atomically (always written since the timestamps change each cycle)'''
+    with atomicwrite.open_for_atomic_write(filename, perm=0o644, fsync=fsync, skip_unchanged=False) as f:
+        f.write(content) # one write of the whole payload
+
+@register('influx')
+async def output_status_influx(config, data):
+    '''Outputs the status as InfluxDB wire protocol (rendered in the event loop, written in a thread)'''
     filename = config.get('filename', '/var/cache/wg-track_influx.out')
-    with atomicwrite.open_for_atomic_write(filename, perm=0o644) as f:
-      for interface, interfacedata, peer, peerdata in data.peeriterator():
-          timestamp = peerdata.get('timestamp')
-          if timestamp is None:
-              timestamp = time.time()
-          timestamp = '{:.0f}'.format(timestamp*1000000000)
-          attrs = ['transfer-rx', 'transfer-tx', 'status']
-          
-          readings = []
-          for attr in attrs:
-              value = peerdata.get(attr)
-              if value is None: # None values shall not be included but these attributes just be omitted
-                continue
-              value = str(value) # Make sure we're dealing with strings now
-              value = value.replace('=','').replace(',','').replace('"','').replace(' ','') # remove any special characters that have meaning in the Influx wire protocol
-              attr = attr.replace('-', '_') # Influx convention is to use underscores instead of dashes
-              if attr in ['transfer-rx', 'transfer-tx']: #integer values
-                if value is not None:
-                  value += 'i'
-              elif attr in ['status']: #string values
-                value = '"' + value + '"'
-              reading = '{attr}={value}'.format(attr=attr, value=value)
-              readings.append(reading)
-          if peerdata.get('status') == 'up:ok':
-              readings.append('is_up=1i')
-          else:
-              readings.append('is_up=0i')
-          peer = peer.replace('=', '\=') # the equal sign needs to be escaped
-          readings = ','.join(readings)    
-          reading = 'wgtrack,interface={interface},peer={peer} {readings} {timestamp}\n'.format(interface=interface, peer=peer, readings=readings, timestamp=timestamp)
-          f.write(reading)
+    content = render_influx(data)
+    await asyncio.get_running_loop().run_in_executor(None, write_file, filename, content, config.getboolean('fsync', False))
+
+@register('influxpush')
+async def output_status_influxpush(config, data):
+    '''Sends the status as InfluxDB wire protocol to Telegraf or InfluxDB (the connection is kept across cycles)'''
+    pusher = exporters.get('influxpush')
+    if pusher is None:
+        batch_size = config.get('batch_size')
+        pusher = influxpush.InfluxPusher(config.get('url', 'udp://127.0.0.1:8094'), batch_size=int(batch_size) if batch_size else None,
+                                         buffer_size=int(config.get('buffer_size', 16777216)), timeout=float(config.get('timeout', 5)),
+                                         compress=config.getboolean('gzip', False), token=config.get('token'))
+        exporters['influxpush'] = pusher
+    await pusher.push(render_influx(data))
+
+@register('prometheus')
+async def output_status_prometheus(config, data):
+    '''Renders the status for the Prometheus exporter (its HTTP server is started on first use)'''
+    exporter = exporters.get('prometheus')
+    if exporter is None:
+        exporter = prometheus.PrometheusExporter(address=config.get('address', '127.0.0.1'), port=int(config.get('port', 9586)),
+                                                 path=config.get('path', '/metrics'), compresslevel=int(config.get('compresslevel', 6)))
+        try:
+            await exporter.start()
+        except OSError as e:
+            logger.error('Prometheus exporter cannot listen on [{0}:{1}]: {2}'.format(exporter.address, exporter.port, e))
+            return # retried next cycle
+        exporters['prometheus'] = exporter
+    exporter.update(data)
+
+async def run_output(backend, config, data, stats):
+    '''Runs an output backend with timeout and records its duration'''
+    timeout = float(config.get('output_timeout', 10))
+    start = clock.monotonic()
+    if backend.blocking:
+        task = asyncio.get_running_loop().run_in_executor(None, backend.func, config, DataSnapshot(data))
+    else:
+        task = asyncio.ensure_future(backend.func(config, data))
+    running[backend.name] = task
+    try:
+        await asyncio.wait_for(asyncio.shield(task), timeout) # the task is kept on timeout so that it is not started again while busy
+    except asyncio.TimeoutError:
+        stats['timeouts'] = stats.get('timeouts', 0) + 1
+        task.add_done_callback(lambda task: task.cancelled() or task.exception()) # result is not of interest anymore
+        logger.warning('Output [{0}] did not finish within {1}s; continuing without waiting for it'.format(backend.name, timeout))
+        return
+    except Exception as e:
+        stats['failures'] = stats.get('failures', 0) + 1
+        logger.error('Output [{0}] failed: [{1}]'.format(backend.name, e))
+    finally:
+        stats['duration'] = clock.monotonic() - start
+    logger.debug('Output [{0}] took {1:.3f}s'.format(backend.name, stats['duration']))
 
 async def output_status(outputs, data):
-    '''Outputs the status information in the requested formats'''
+    '''Outputs the status information in the requested formats (all outputs run concurrently)'''
+    global entry_points_loaded
+    if not entry_points_loaded:
+        entry_points_loaded = True
+        load_entry_points()
+    all_stats = getattr(data, 'stats', dict()).setdefault('outputs', dict())
+    runs = []
     for output, output_config in outputs.items():
-        if output == 'influx':
-            await output_status_influx(output_config, data)
-        else:
-            logger.error('Unknown output [[{0}] specified in config file'.format(output))
+        backend = backends.get(output)
+        if backend is None:
+            logger.error('Unknown output [{0}] specified in config file'.format(output))
+            continue
+        task = running.get(output)
+        if (task is not None) and not task.done(): # still busy since the previous cycle
+            logger.warning('Output [{0}] skipped since it is still busy'.format(output))
+            continue
+        runs.append(run_output(backend, output_config, data, all_stats.setdefault(output, dict())))
+    await asyncio.gather(*runs)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""Compact record for the attributes of a peer that behaves like a dictionary"""
+
+import binascii
+import collections.abc
+
+
+# Attributes kept in slots (attribute name -> slot name); other attributes are kept in a dictionary
+FIELDS = ['preshared-key', 'endpoint', 'allowed-ips', 'latest-handshake', 'transfer-rx', 'transfer-tx', 'persistent-keepalive',
+          'latest-handshake-seconds', 'handshake-status', 'timestamp', 'rate-rx', 'rate-tx',
+          'status', 'cycle-counter', 'cycle-synced', 'ping-address', 'ping-failcounter', 'backingoff-limit', 'transfer-previous',
+          'config_endpoint']
+SLOTS = { field: field.replace('-', '_') for field in FIELDS }
+
+
+class PeerRecord(collections.abc.MutableMapping):
+    '''Attributes of a peer in fixed slots (updated in place each cycle); provides the interface of a dictionary'''
+    __slots__ = tuple(slot for slot in SLOTS.values() if slot not in ['preshared_key', 'allowed_ips', 'latest_handshake_seconds']) + ('_preshared_key', '_allowed_ips', 'extras')
+
+    def __init__(self, data=None):
+        '''Constructor; the record is initialized with the given dictionary if provided'''
+        self.extras = None # dictionary for attributes without slot (created when needed)
+        if data:
+            self.update(data)
+
+    @property
+    def preshared_key(self):
+        '''Preshared key in base64 format (stored as 32 bytes)'''
+        value = self._preshared_key
+        if isinstance(value, bytes):
+            return binascii.b2a_base64(value, newline=False).decode('ascii')
+        return value
+
+    @preshared_key.setter
+    def preshared_key(self, value):
+        if isinstance(value, str):
+            try:
+                decoded = binascii.a2b_base64(value)
+                if len(decoded) == 32:
+                    value = decoded
+            except binascii.Error:
+                pass # keep as string
+        self._preshared_key = value
+
+    @preshared_key.deleter
+    def preshared_key(self):
+        del self._preshared_key
+
+    @property
+    def allowed_ips(self):
+        '''List of allowed IPs (stored as comma-separated text if parsed from the dump; the list is created on access)'''
+        value = self._allowed_ips
+        if isinstance(value, str):
+            return value.split(',')
+        return value
+
+    @allowed_ips.setter
+    def allowed_ips(self, value):
+        self._allowed_ips = value
+
+    @allowed_ips.deleter
+    def allowed_ips(self):
+        del self._allowed_ips
+
+    @property
+    def latest_handshake_seconds(self):
+        '''Seconds between the latest handshake and the time of the status (derived, so that it need not be updated for each peer each cycle)'''
+        latest_handshake = self.latest_handshake
+        if latest_handshake == 0: # no handshake took place successfully yet
+            return None
+        return int(self.timestamp) - latest_handshake
+
+    @latest_handshake_seconds.setter
+    def latest_handshake_seconds(self, value):
+        pass # always derived from the latest handshake and the timestamp
+
+    @latest_handshake_seconds.deleter
+    def latest_handshake_seconds(self):
+        pass
+
+    def set_allowed_ips(self, text):
+        '''Sets the allowed IPs given as comma-separated text'''
+        self._allowed_ips = text
+
+    def __getitem__(self, key):
+        slot = SLOTS.get(key)
+        if slot is not None:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extras is None:
+            raise KeyError(key)
+        return self.extras[key]
+
+    def get(self, key, default=None):
+        slot = SLOTS.get(key)
+        if slot is not None:
+            return getattr(self, slot, default)
+        if self.extras is None:
+            return default
+        return self.extras.get(key, default)
+
+    def __setitem__(self, key, value):
+        slot = SLOTS.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self.extras is None:
+                self.extras = dict()
+            self.extras[key] = value
+
+    def __delitem__(self, key):
+        slot = SLOTS.get(key)
+        if slot is not None:
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            if self.extras is None:
+                raise KeyError(key)
+            del self.extras[key]
+
+    def __contains__(self, key):
+        slot = SLOTS.get(key)
+        if slot is not None:
+            return hasattr(self, slot)
+        return (self.extras is not None) and (key in self.extras)
+
+    def __iter__(self):
+        for field, slot in SLOTS.items():
+            if hasattr(self, slot):
+                yield field
+        if self.extras is not None:
+            yield from self.extras
+
+    def __len__(self):
+        return sum(1 for field in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        '''Returns the attributes as dictionary'''
+        return dict(self)
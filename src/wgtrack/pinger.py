@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for checking the reachability of peers by ICMP echo requests sent over one shared socket per interface"""
+
+import asyncio
+import errno
+import logging
+import os
+import socket
+import struct
+import time
+
+
+logger = logging.getLogger(__name__);
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+ICMP_HEADER = struct.Struct('!BBHHH')
+PAYLOAD = b'wgtrack-echo-req'
+RECEIVE_BUFFER_SIZE = 1 << 20 # replies of many peers may arrive at about the same time
+SOL_RAW = 255
+ICMP_FILTER = 1
+ICMP6_FILTER = 1
+SEND_RETRY_DELAY = 0.01 # seconds to wait before sending again if the queue of the device is full (no writability is signalled then)
+SOCKET_RETRY_INTERVAL = 60 # seconds after which opening a socket is tried again if it failed for a transient reason
+PERMANENT_ERRNOS = (errno.EPERM, errno.EACCES, errno.EPROTONOSUPPORT, errno.EAFNOSUPPORT) # opening will not succeed later either
+
+
+def checksum(data):
+    '''Calculates the internet checksum (RFC 1071) of the given data'''
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!{0}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class IcmpSocket():
+    '''ICMP/ICMPv6 socket bound to an interface; echo replies are matched to requests by id and sequence number'''
+    ident_offset = 0 # distinguishes raw sockets since these receive all ICMP packets
+
+    def __init__(self, interface, family):
+        '''Constructor (raises OSError if the socket cannot be opened)'''
+        self.interface = interface
+        self.family = family
+        self.loop = asyncio.get_event_loop()
+        proto = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+        try: # unprivileged datagram socket (see net.ipv4.ping_group_range); the kernel sets the identifier
+            self.sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+            self.raw = False
+        except PermissionError: # raw socket requires CAP_NET_RAW
+            self.sock = socket.socket(family, socket.SOCK_RAW, proto)
+            self.raw = True
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode('utf8'))
+            self.sock.setblocking(False)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+            if self.raw:
+                self.set_filter()
+                IcmpSocket.ident_offset += 1
+                self.ident = (os.getpid() + IcmpSocket.ident_offset) & 0xffff
+            else:
+                self.sock.bind(('::' if family == socket.AF_INET6 else '0.0.0.0', 0))
+                self.ident = self.sock.getsockname()[1]
+        except OSError:
+            self.sock.close()
+            raise
+        self.seq = 0
+        self.pending = dict() # sequence number -> (packed destination address, future)
+        self.writable = None # future completed once the full send buffer has room again (shared by all waiting senders)
+        self.loop.add_reader(self.sock.fileno(), self.receive)
+
+    def set_filter(self):
+        '''Lets the kernel drop all ICMP messages except echo replies on raw sockets'''
+        try:
+            if self.family == socket.AF_INET6:
+                blocked = [0xffffffff] * 8 # bit set: message type is blocked
+                blocked[ICMPV6_ECHO_REPLY >> 5] &= ~(1 << (ICMPV6_ECHO_REPLY & 31))
+                self.sock.setsockopt(socket.IPPROTO_ICMPV6, ICMP6_FILTER, struct.pack('=8I', *blocked))
+            else:
+                self.sock.setsockopt(SOL_RAW, ICMP_FILTER, struct.pack('=I', ~(1 << ICMP_ECHO_REPLY) & 0xffffffff))
+        except OSError as e:
+            logger.debug('Cannot set ICMP filter: {0}'.format(e))
+
+    def close(self):
+        '''Closes the socket; pending echo requests fail'''
+        self.loop.remove_reader(self.sock.fileno())
+        if self.writable is not None:
+            self.notify_writable()
+        self.sock.close()
+        for address, future in self.pending.values():
+            if not future.done():
+                future.set_result(False)
+
+    def build_request(self, seq):
+        '''Returns an echo request packet'''
+        if self.family == socket.AF_INET6: # the kernel calculates the checksum for ICMPv6
+            return ICMP_HEADER.pack(ICMPV6_ECHO_REQUEST, 0, 0, self.ident, seq) + PAYLOAD
+        packet = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self.ident, seq) + PAYLOAD
+        return packet[:2] + struct.pack('!H', checksum(packet)) + packet[4:]
+
+    def notify_writable(self):
+        '''Wakes up the senders waiting for room in the send buffer'''
+        self.loop.remove_writer(self.sock.fileno())
+        writable, self.writable = self.writable, None
+        if not writable.done():
+            writable.set_result(None)
+
+    async def send(self, packet, destination, timeout):
+        '''Sends a packet; waits while the send buffer is full (bursts of requests); returns False if it could not be sent in time'''
+        deadline = self.loop.time() + timeout
+        while True:
+            try:
+                self.sock.sendto(packet, (destination, 0))
+                return True
+            except (BlockingIOError, InterruptedError): # send buffer full
+                if self.writable is None:
+                    self.writable = self.loop.create_future()
+                    self.loop.add_writer(self.sock.fileno(), self.notify_writable)
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.writable), deadline - self.loop.time())
+                except asyncio.TimeoutError:
+                    return False
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                if self.loop.time() + SEND_RETRY_DELAY > deadline:
+                    return False
+                await asyncio.sleep(SEND_RETRY_DELAY)
+
+    def receive(self):
+        '''Reads all available packets and completes the futures of matching echo requests'''
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug('Error receiving on ICMP socket of interface [{0}]: {1}'.format(self.interface, e))
+                return
+            if self.raw and (self.family == socket.AF_INET): # raw IPv4 sockets include the IP header
+                data = data[(data[0] & 0x0f) * 4:] if data else data
+            if len(data) < ICMP_HEADER.size:
+                continue
+            icmptype, code, _, ident, seq = ICMP_HEADER.unpack_from(data)
+            if icmptype != (ICMPV6_ECHO_REPLY if self.family == socket.AF_INET6 else ICMP_ECHO_REPLY):
+                continue
+            if self.raw and (ident != self.ident):
+                continue
+            address, future = self.pending.get(seq, (None, None))
+            if (future is None) or future.done():
+                continue
+            try:
+                if socket.inet_pton(self.family, addr[0].partition('%')[0]) != address:
+                    continue
+            except OSError:
+                continue
+            future.set_result(True)
+
+    async def ping(self, destination, timeout=1):
+        '''Sends an echo request and waits for the reply; returns 0 on success (like the ping command)'''
+        for i in range(0x10000): # find a free sequence number
+            self.seq = (self.seq + 1) & 0xffff
+            if self.seq not in self.pending:
+                break
+        seq = self.seq
+        future = self.loop.create_future()
+        try:
+            self.pending[seq] = (socket.inet_pton(self.family, destination), future)
+            if not await self.send(self.build_request(seq), destination, timeout):
+                logger.warning('Echo request to [{0}] via [{1}] dropped since the send buffer stayed full for {2}s'.format(destination, self.interface, timeout))
+                return 1
+            if len(self.pending) % 64 == 0: # many requests are sent at once; read replies in between
+                self.receive()
+            if await asyncio.wait_for(future, timeout):
+                return 0
+        except asyncio.TimeoutError:
+            pass
+        except OSError as e:
+            logger.debug('Error sending echo request to [{0}] via [{1}]: {2}'.format(destination, self.interface, e))
+            if e.errno == errno.ENODEV: # interface vanished; socket needs to be opened anew
+                raise
+        finally:
+            self.pending.pop(seq, None)
+        return 1
+
+
+class Pinger():
+    '''Class for checking reachability; uses ICMP sockets if possible and the ping command otherwise'''
+
+    def __init__(self, use_socket=True, timeout=1):
+        '''Constructor'''
+        self.use_socket = use_socket
+        self.timeout = timeout
+        self.sockets = dict() # (interface, family) -> IcmpSocket, None if it cannot be opened
+        self.socket_failures = dict() # (interface, family) -> time of the last transient failure to open the socket
+
+    def get_socket(self, interface, family):
+        '''Returns the shared ICMP socket for the given interface and address family (None if not available)'''
+        key = (interface, family)
+        if key not in self.sockets:
+            failed = self.socket_failures.get(key)
+            if (failed is not None) and (time.monotonic() - failed < SOCKET_RETRY_INTERVAL):
+                return None
+            try:
+                self.sockets[key] = IcmpSocket(interface, family)
+                self.socket_failures.pop(key, None)
+            except OSError as e:
+                if e.errno in PERMANENT_ERRNOS: # e.g. missing privileges; don't try again
+                    logger.warning('Cannot open ICMP socket for interface [{0}] [{1}]; using ping command instead'.format(interface, e))
+                    self.sockets[key] = None
+                else: # e.g. interface not up yet
+                    logger.warning('Cannot open ICMP socket for interface [{0}] [{1}]; using ping command for {2}s'.format(interface, e, SOCKET_RETRY_INTERVAL))
+                    self.socket_failures[key] = time.monotonic()
+                    return None
+        return self.sockets[key]
+
+    def close(self):
+        '''Closes all sockets'''
+        for sock in self.sockets.values():
+            if sock is not None:
+                sock.close()
+        self.sockets = dict()
+        self.socket_failures = dict()
+
+    async def ping_command(self, destination, interface, ping6=False):
+        '''Asynchronously execute the ping command to check reachability'''
+        command = 'ping'
+        if ping6 or (':' in destination):
+            command = 'ping6'
+        proc = await asyncio.create_subprocess_exec(command, '-q', '-c', '1', '-w', '1', '-W', '1', '-I', interface, destination, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        return proc.returncode
+
+    async def ping(self, destination, interface, ping6=False):
+        '''Checks reachability of the destination via the given interface; returns 0 on success (like the ping command)'''
+        if self.use_socket:
+            family = socket.AF_INET6 if ping6 or (':' in destination) else socket.AF_INET
+            sock = self.get_socket(interface, family)
+            if sock is not None:
+                try:
+                    return await sock.ping(destination, self.timeout)
+                except OSError:
+                    sock.close()
+                    del self.sockets[(interface, family)]
+                    return 1
+        return await self.ping_command(destination, interface, ping6)
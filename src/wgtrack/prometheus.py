@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""Exporter serving the status in the Prometheus text format via HTTP from within the event loop"""
+
+import asyncio
+import email.utils
+import gzip
+import hashlib
+import logging
+
+from . import clock
+
+
+logger = logging.getLogger(__name__);
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REASONS = { 200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 503: 'Service Unavailable' }
+
+# Metrics of the peers: name, type, help text
+PEER_METRICS = [
+    ('wgtrack_peer_receive_bytes_total', 'counter', 'Bytes received from the peer'),
+    ('wgtrack_peer_transmit_bytes_total', 'counter', 'Bytes sent to the peer'),
+    ('wgtrack_peer_receive_rate_bytes', 'gauge', 'Bytes per second received from the peer recently'),
+    ('wgtrack_peer_transmit_rate_bytes', 'gauge', 'Bytes per second sent to the peer recently'),
+    ('wgtrack_peer_latest_handshake_age_seconds', 'gauge', 'Seconds since the latest handshake with the peer'),
+    ('wgtrack_peer_up', 'gauge', 'Whether the link to the peer is up (status "up:ok")'),
+    ('wgtrack_peer_status', 'gauge', 'Status of the link to the peer as determined by wgtrack (1 for the current status)'),
+]
+
+# Metrics of the tracker itself: name, type, help text, function getting the value from the statistics
+TRACKER_METRICS = [
+    ('wgtrack_cycle_duration_seconds', 'gauge', 'Duration of the previous cycle of periodic tasks', lambda stats: stats.get('cycle-duration')),
+    ('wgtrack_status_duration_seconds', 'gauge', 'Duration of retrieving the WireGuard status in the current cycle', lambda stats: stats.get('status-duration')),
+    ('wgtrack_cycles_total', 'counter', 'Cycles of periodic tasks completed', lambda stats: stats.get('cycles')),
+    ('wgtrack_peers_visited', 'gauge', 'Peers looked at in the current cycle', lambda stats: stats.get('peers-visited')),
+    ('wgtrack_pings_sent_total', 'counter', 'Echo requests sent', lambda stats: stats.get('pings-sent')),
+    ('wgtrack_pings_saved_total', 'counter', 'Echo requests not needed since the peer had just sent data', lambda stats: stats.get('pings-saved')),
+    ('wgtrack_queue_processed_total', 'counter', 'Events processed from the event queue', lambda stats: stats.get('queue', dict()).get('processed')),
+    ('wgtrack_dns_queries_total', 'counter', 'DNS queries sent', lambda stats: stats.get('dns', dict()).get('queries')),
+]
+
+
+def escape_label(value):
+    '''Escapes a label value as required by the Prometheus text format'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusExporter():
+    '''Keeps the exposition page rendered once per cycle and serves it to scrapers'''
+
+    def __init__(self, address='127.0.0.1', port=9586, path='/metrics', compresslevel=6):
+        '''Constructor'''
+        self.address = address
+        self.port = port
+        self.path = path
+        self.compresslevel = compresslevel
+        self.server = None
+        self.body = None # rendered page as bytes (None until the first update)
+        self.body_gzip = None # compressed page (created on first request)
+        self.etag = None
+        self.etag_gzip = None # the compressed page is a different representation with its own tag
+        self.last_modified = None # time of the last change of the page (seconds since the epoch)
+        self.last_modified_text = None # the same in HTTP date format
+        self.stats = { 'scrapes': 0, 'not-modified': 0 }
+
+    async def start(self):
+        '''Starts the HTTP server'''
+        self.server = await asyncio.start_server(self.handle_request, self.address or None, self.port)
+        logger.info('Serving Prometheus metrics on [{0}:{1}{2}]'.format(self.address, self.port, self.path))
+
+    async def stop(self):
+        '''Stops the HTTP server'''
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def render(self, data):
+        '''Renders the status as page in the Prometheus text format (returns a string)'''
+        lines = { name: ['# HELP {0} {1}\n# TYPE {0} {2}\n'.format(name, text, metrictype)] for name, metrictype, text in PEER_METRICS }
+        receive, transmit, receive_rate, transmit_rate, handshake, up, status = (lines[name] for name, metrictype, text in PEER_METRICS)
+        for interface, interfacedata, peer, peerdata in data.peeriterator():
+            labels = 'interface="{0}",peer="{1}"'.format(escape_label(interface), escape_label(peer))
+            value = peerdata.get('transfer-rx')
+            if value is not None:
+                receive.append('wgtrack_peer_receive_bytes_total{{{0}}} {1}\n'.format(labels, value))
+            value = peerdata.get('transfer-tx')
+            if value is not None:
+                transmit.append('wgtrack_peer_transmit_bytes_total{{{0}}} {1}\n'.format(labels, value))
+            value = peerdata.get('rate-rx')
+            if value is not None:
+                receive_rate.append('wgtrack_peer_receive_rate_bytes{{{0}}} {1:.1f}\n'.format(labels, value))
+            value = peerdata.get('rate-tx')
+            if value is not None:
+                transmit_rate.append('wgtrack_peer_transmit_rate_bytes{{{0}}} {1:.1f}\n'.format(labels, value))
+            value = peerdata.get('latest-handshake-seconds')
+            if value is not None:
+                handshake.append('wgtrack_peer_latest_handshake_age_seconds{{{0}}} {1}\n'.format(labels, value))
+            value = peerdata.get('status')
+            up.append('wgtrack_peer_up{{{0}}} {1}\n'.format(labels, 1 if value == 'up:ok' else 0))
+            if value is not None:
+                status.append('wgtrack_peer_status{{{0},status="{1}"}} 1\n'.format(labels, escape_label(value)))
+        result = [ ''.join(lines[name]) for name, metrictype, text in PEER_METRICS ]
+        for name, metrictype, text, func in TRACKER_METRICS:
+            value = func(data.stats)
+            if value is not None:
+                result.append('# HELP {0} {1}\n# TYPE {0} {2}\n{0} {3}\n'.format(name, text, metrictype, value))
+        result.append('# HELP wgtrack_scrapes_total Requests of the metrics page\n# TYPE wgtrack_scrapes_total counter\n')
+        result.append('wgtrack_scrapes_total {0}\n'.format(self.stats['scrapes']))
+        return ''.join(result)
+
+    def update(self, data):
+        '''Renders the page anew; it is kept (with the same validators) if its content did not change'''
+        body = self.render(data).encode('utf-8')
+        if body == self.body:
+            return
+        self.body = body
+        self.body_gzip = None
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        self.etag, self.etag_gzip = '"{0}"'.format(digest), '"{0}-gzip"'.format(digest)
+        self.last_modified = int(clock.time())
+        self.last_modified_text = email.utils.formatdate(self.last_modified, usegmt=True)
+
+    def get_body_gzip(self):
+        '''Returns the compressed page (compressed only once per update)'''
+        if self.body_gzip is None:
+            self.body_gzip = gzip.compress(self.body, compresslevel=self.compresslevel)
+        return self.body_gzip
+
+    def is_not_modified(self, headers):
+        '''Checks whether the client's copy of the page is still current according to the conditional request headers'''
+        if_none_match = headers.get('if-none-match')
+        if if_none_match is not None: # takes precedence over "If-Modified-Since"
+            tags = [ tag.strip() for tag in if_none_match.split(',') ]
+            etags = [self.etag, self.etag_gzip]
+            return any((tag in etags) or (tag[2:] in etags) or (tag == '*') for tag in tags) # weak comparison
+        if_modified_since = headers.get('if-modified-since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return self.last_modified <= since
+        return False
+
+    def accepts_gzip(self, headers):
+        '''Checks whether the client accepts a gzip-compressed response'''
+        for coding in headers.get('accept-encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() == 'gzip':
+                return params.replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']
+        return False
+
+    async def read_request(self, reader):
+        '''Reads the request line and headers; returns the method, path, and headers (dictionary with lowercase names)'''
+        requestline = (await reader.readline()).decode('latin-1').strip()
+        headers = dict()
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ['\r\n', '\n', '']:
+                break
+            if len(headers) >= 100:
+                raise ValueError('too many header lines')
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        method, _, rest = requestline.partition(' ')
+        path = rest.partition(' ')[0].partition('?')[0]
+        return method, path, headers
+
+    async def handle_request(self, reader, writer):
+        '''Serves a single request'''
+        try:
+            try:
+                method, path, headers = await asyncio.wait_for(self.read_request(reader), 10)
+            except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError, UnicodeError):
+                await self.respond(writer, 400)
+                return
+            if path != self.path:
+                await self.respond(writer, 404)
+            elif method not in ['GET', 'HEAD']:
+                await self.respond(writer, 405, extra={ 'Allow': 'GET, HEAD' })
+            elif self.body is None:
+                await self.respond(writer, 503)
+            else:
+                self.stats['scrapes'] += 1
+                compressed = self.accepts_gzip(headers)
+                validators = { 'ETag': self.etag_gzip if compressed else self.etag, 'Last-Modified': self.last_modified_text, 'Vary': 'Accept-Encoding' }
+                if self.is_not_modified(headers):
+                    self.stats['not-modified'] += 1
+                    await self.respond(writer, 304, extra=validators)
+                elif compressed:
+                    await self.respond(writer, 200, self.get_body_gzip(), { **validators, 'Content-Encoding': 'gzip' }, send_body=(method == 'GET'))
+                else:
+                    await self.respond(writer, 200, self.body, validators, send_body=(method == 'GET'))
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug('Connection of scraper lost: [{0}]'.format(e))
+        finally:
+            writer.close()
+
+    async def respond(self, writer, code, body=None, extra=None, send_body=True):
+        '''Sends a response (the connection is closed afterwards)'''
+        if body is None:
+            body = b'' if code == 304 else '{0} {1}\n'.format(code, REASONS[code]).encode('ascii')
+        headers = { 'Content-Type': CONTENT_TYPE, 'Content-Length': str(len(body)), 'Connection': 'close', **(extra or dict()) }
+        if code == 304:
+            del headers['Content-Type'], headers['Content-Length']
+        head = 'HTTP/1.1 {0} {1}\r\n'.format(code, REASONS[code]) + ''.join('{0}: {1}\r\n'.format(k, v) for k, v in headers.items()) + '\r\n'
+        writer.write(head.encode('latin-1'))
+        if send_body:
+            writer.write(body)
+        await writer.drain()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for asynchronous DNS resolution of endpoint hostnames with a cache that honours record TTLs"""
+
+import asyncio
+import logging
+import os
+import socket
+import struct
+
+from . import clock
+
+
+logger = logging.getLogger(__name__);
+
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+CLASS_IN = 1
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+DNS_HEADER = struct.Struct('!HHHHHH')
+RR_HEADER = struct.Struct('!HHIH')
+
+
+class DnsError(Exception):
+    '''Error while querying a name server'''
+    pass
+
+
+def read_nameservers(filename='/etc/resolv.conf'):
+    '''Returns the name servers configured in the given resolv.conf file'''
+    nameservers = []
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if (len(parts) >= 2) and (parts[0] == 'nameserver'):
+                    nameservers.append(parts[1].partition('%')[0])
+    except OSError as e:
+        logger.warning('Cannot read name servers from [{0}]: {1}'.format(filename, e))
+    return nameservers
+
+def encode_name(hostname):
+    '''Encodes a hostname in DNS wire format'''
+    result = b''
+    for label in hostname.rstrip('.').split('.'):
+        try:
+            label = label.encode('idna')
+        except UnicodeError: # e.g. empty label or label too long
+            raise DnsError('Invalid hostname [{0}]'.format(hostname)) from None
+        if not (0 < len(label) < 64):
+            raise DnsError('Invalid hostname [{0}]'.format(hostname))
+        result += bytes([len(label)]) + label
+    return result + b'\0'
+
+def skip_name(message, offset):
+    '''Returns the offset after the (possibly compressed) name at the given offset'''
+    while True:
+        length = message[offset]
+        if length & 0xc0 == 0xc0: # compression pointer
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+def build_query(query_id, hostname, qtype, flags=FLAG_RD):
+    '''Returns a DNS query message'''
+    return DNS_HEADER.pack(query_id, flags, 1, 0, 0, 0) + encode_name(hostname) + struct.pack('!HH', qtype, CLASS_IN)
+
+def parse_response(message, qtype):
+    '''Parses a DNS response; returns the rcode, the addresses with their minimum TTL, and the TTL for negative caching'''
+    query_id, flags, qdcount, ancount, nscount, arcount = DNS_HEADER.unpack_from(message)
+    if flags & FLAG_TC:
+        raise DnsError('Truncated response')
+    offset = DNS_HEADER.size
+    for i in range(qdcount):
+        offset = skip_name(message, offset) + 4
+    addresses = []
+    ttl = None
+    negative_ttl = None
+    for i in range(ancount + nscount):
+        offset = skip_name(message, offset)
+        rrtype, rrclass, rrttl, rdlength = RR_HEADER.unpack_from(message, offset)
+        offset += RR_HEADER.size
+        rdata = message[offset:offset+rdlength]
+        offset += rdlength
+        if i < ancount: # answer section (a CNAME chain limits the TTL as well)
+            ttl = rrttl if ttl is None else min(ttl, rrttl)
+            if (rrtype == qtype == TYPE_A) and (rdlength == 4):
+                addresses.append(socket.inet_ntop(socket.AF_INET, rdata))
+            elif (rrtype == qtype == TYPE_AAAA) and (rdlength == 16):
+                addresses.append(socket.inet_ntop(socket.AF_INET6, rdata))
+        elif rrtype == TYPE_SOA: # authority section; negative caching according to RFC 2308
+            minimum = struct.unpack_from('!I', rdata, len(rdata) - 4)[0]
+            negative_ttl = min(rrttl, minimum)
+    return flags & 0x000f, addresses, ttl, negative_ttl
+
+
+class DnsClientProtocol(asyncio.DatagramProtocol):
+    '''Protocol for receiving the response to a single DNS query'''
+
+    def __init__(self, query_id, future):
+        '''Constructor'''
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        '''Completes the future with the matching response'''
+        if (len(data) >= DNS_HEADER.size) and (DNS_HEADER.unpack_from(data)[0] == self.query_id) and not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        '''Fails the future on errors like "connection refused"'''
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class Resolver():
+    '''Asynchronous resolver that caches results according to their TTL and merges concurrent lookups of the same name'''
+
+    def __init__(self, nameservers=None, use_builtin=True, timeout=2, default_ttl=60, negative_ttl=60):
+        '''Constructor; "nameservers" is a list of addresses or (address, port) tuples (default: from resolv.conf)'''
+        if nameservers is None:
+            nameservers = read_nameservers() if use_builtin else []
+        self.nameservers = [ ns if isinstance(ns, tuple) else (ns, 53) for ns in nameservers ]
+        self.use_builtin = use_builtin
+        self.timeout = timeout
+        self.default_ttl = default_ttl # for results of the system resolver (no TTL available)
+        self.negative_ttl = negative_ttl # for failed lookups (upper bound of the TTL provided by the name server)
+        self.cache = dict() # hostname -> (expiry time, list of addresses); empty list for failed lookups
+        self.inflight = dict() # hostname -> future of the ongoing lookup
+        self.stats = { 'hits': 0, 'negative-hits': 0, 'misses': 0, 'coalesced': 0, 'queries': 0, 'failures': 0 }
+
+    def invalidate(self, hostname=None):
+        '''Removes the given hostname (or all) from the cache'''
+        if hostname is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(hostname, None)
+
+    async def query(self, hostname, qtype):
+        '''Queries the configured name servers for the given record type; returns the result of parse_response'''
+        loop = asyncio.get_event_loop()
+        error = DnsError('No name server configured')
+        for nameserver in self.nameservers:
+            query_id = struct.unpack('!H', os.urandom(2))[0]
+            future = loop.create_future()
+            self.stats['queries'] += 1
+            try:
+                family = socket.AF_INET6 if ':' in nameserver[0] else socket.AF_INET
+                transport, protocol = await loop.create_datagram_endpoint(lambda: DnsClientProtocol(query_id, future), remote_addr=nameserver, family=family)
+                try:
+                    transport.sendto(build_query(query_id, hostname, qtype))
+                    response = await asyncio.wait_for(future, self.timeout)
+                finally:
+                    transport.close()
+                result = parse_response(response, qtype)
+                if result[0] in [RCODE_NOERROR, RCODE_NXDOMAIN]:
+                    return result
+                error = DnsError('Name server [{0}] responded with rcode {1}'.format(nameserver[0], result[0]))
+            except asyncio.TimeoutError:
+                error = DnsError('Name server [{0}] did not respond within {1}s'.format(nameserver[0], self.timeout))
+            except (OSError, DnsError, IndexError, struct.error) as e:
+                error = DnsError('Querying name server [{0}] failed: {1}'.format(nameserver[0], e))
+        raise error
+
+    async def lookup_builtin(self, hostname):
+        '''Resolves the hostname using the own DNS client; returns addresses and TTL (empty list if there are no records)'''
+        results = await asyncio.gather(self.query(hostname, TYPE_A), self.query(hostname, TYPE_AAAA), return_exceptions=True)
+        for result in results:
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+        errors = [ result for result in results if isinstance(result, Exception) ]
+        if len(errors) == len(results):
+            raise errors[0]
+        results = [ result for result in results if not isinstance(result, Exception) ]
+        addresses = [ address for result in results for address in result[1] ] # IPv4 addresses first
+        if addresses:
+            return addresses, min(result[2] for result in results if result[1])
+        negative_ttls = [ result[3] for result in results if result[3] is not None ]
+        return [], min(negative_ttls + [self.negative_ttl]) # the configured TTL is the upper bound (SOA minimums can be hours)
+
+    async def lookup_system(self, hostname):
+        '''Resolves the hostname using the system resolver (in a worker thread); returns addresses and TTL'''
+        loop = asyncio.get_event_loop()
+        infos = await loop.getaddrinfo(hostname, 0)
+        addresses = []
+        for info in infos:
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        return addresses, self.default_ttl
+
+    async def lookup(self, hostname):
+        '''Resolves the hostname (own DNS client first, system resolver as fallback) and caches the result'''
+        addresses = []
+        ttl = self.negative_ttl
+        try:
+            encode_name(hostname) # neither resolver can handle invalid names; don't query at all
+        except DnsError as e:
+            self.stats['failures'] += 1
+            self.cache[hostname] = (clock.monotonic() + ttl, [])
+            raise socket.gaierror(socket.EAI_NONAME, str(e)) from None
+        if self.use_builtin:
+            try:
+                addresses, ttl = await self.lookup_builtin(hostname)
+            except DnsError as e:
+                logger.debug('DNS query for [{0}] failed [{1}]; trying system resolver'.format(hostname, e))
+        if not addresses: # the system resolver also considers /etc/hosts etc.
+            try:
+                addresses, ttl = await self.lookup_system(hostname)
+            except socket.gaierror:
+                self.stats['failures'] += 1
+                self.cache[hostname] = (clock.monotonic() + ttl, [])
+                raise
+        self.cache[hostname] = (clock.monotonic() + ttl, addresses)
+        return addresses
+
+    async def resolve(self, hostname):
+        '''Returns the list of addresses of the hostname (raises socket.gaierror if it cannot be resolved)'''
+        expiry, addresses = self.cache.get(hostname, (0, None))
+        if expiry > clock.monotonic():
+            if addresses:
+                self.stats['hits'] += 1
+                return addresses
+            self.stats['negative-hits'] += 1
+            raise socket.gaierror(socket.EAI_NONAME, 'Name resolution failed recently (cached)')
+        future = self.inflight.get(hostname)
+        if future is not None: # merge with ongoing lookup
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(future)
+        self.stats['misses'] += 1
+        future = asyncio.ensure_future(self.lookup(hostname))
+        self.inflight[hostname] = future
+        future.add_done_callback(lambda f: self.lookup_done(hostname, f))
+        return await asyncio.shield(future)
+
+    def lookup_done(self, hostname, future):
+        '''Cleans up after a lookup finished'''
+        self.inflight.pop(hostname, None)
+        if not future.cancelled():
+            future.exception() # mark as retrieved in case nobody waits for the result anymore
+
+    async def resolve_first(self, hostname):
+        '''Returns the first address of the hostname (raises socket.gaierror if it cannot be resolved)'''
+        return (await self.resolve(hostname))[0]
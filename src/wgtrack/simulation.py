@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+
+"""Simulation of many WireGuard peers with scripted outages and IP changes, driven by a virtual clock"""
+
+import asyncio
+import base64
+import getopt
+import heapq
+import logging
+import random
+import socket
+import statistics
+import sys
+import time
+
+from . import clock
+from . import config
+from . import datakeeper
+from . import eventprocessor
+from . import resolver
+from . import wg_command
+
+
+logger = logging.getLogger(__name__);
+
+REKEY_AFTER_TIME = 120 # WireGuard renews the handshake after this number of seconds
+
+
+class SimulatedPeer():
+    '''State of a simulated peer'''
+
+    def __init__(self, index, interface, key, hostname, address, ping_address):
+        '''Constructor'''
+        self.index = index
+        self.interface = interface
+        self.key = key
+        self.hostname = hostname # None for peers configured with an IP address
+        self.address = address # address the peer is actually reachable at
+        self.endpoint = address # address configured in WireGuard
+        self.ping_address = ping_address
+        self.down = False # outage
+        self.latest_handshake = 0
+        self.transfer_rx = 0
+        self.transfer_tx = 0
+
+
+class SimulatedNetwork():
+    '''Peers, their DNS records, and a script of outages and IP changes'''
+
+    def __init__(self, peers=1000, interfaces=4, hostname_share=0.5, seed=1):
+        '''Constructor'''
+        self.rnd = random.Random(seed)
+        self.peers = []
+        self.by_key = dict() # (interface, public key) -> peer
+        self.by_ping_address = dict() # ping address -> peer
+        self.dns = dict() # hostname -> address
+        self.events = [] # heap of tuples (time, sequence number, kind, peer index)
+        self.listeners = [] # functions called with (time, kind, peer) when an event takes place
+        self.counters = { 'wg-show': 0, 'wg-set': 0, 'endpoints-set': 0, 'pings': 0, 'dns-lookups': 0 }
+        for i in range(peers):
+            interface = 'wg{0}'.format(i % interfaces)
+            key = base64.b64encode(self.rnd.getrandbits(256).to_bytes(32, 'big')).decode('ascii')
+            hostname = 'peer{0}.example.net'.format(i) if self.rnd.random() < hostname_share else None
+            peer = SimulatedPeer(i, interface, key, hostname, self.new_address(), '10.{0}.{1}.{2}'.format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff))
+            self.peers.append(peer)
+            self.by_key[(interface, key)] = peer
+            self.by_ping_address[peer.ping_address] = peer
+            if hostname is not None:
+                self.dns[hostname] = peer.address
+        self.interfaces = sorted(set(peer.interface for peer in self.peers))
+        self.peers_by_interface = { interface: [ peer for peer in self.peers if peer.interface == interface ] for interface in self.interfaces }
+
+    def new_address(self):
+        '''Returns a random public IPv4 address'''
+        return '203.{0}.{1}.{2}'.format(self.rnd.randint(0, 255), self.rnd.randint(0, 255), self.rnd.randint(1, 254))
+
+    def add_event(self, when, kind, peer):
+        '''Schedules an event ("outage", "recovery", or "ipchange") for the given peer'''
+        heapq.heappush(self.events, (when, len(self.events), kind, peer.index))
+
+    def script_events(self, start, duration, outage_rate=0.01, outage_duration=600, ipchange_rate=0.01):
+        '''Schedules random outages and IP changes; rates are given per peer and hour, the duration is the average in seconds'''
+        for peer in self.peers:
+            when = start
+            while outage_rate > 0:
+                when += self.rnd.expovariate(outage_rate / 3600)
+                if when >= start + duration:
+                    break
+                self.add_event(when, 'outage', peer)
+                when += self.rnd.expovariate(1 / outage_duration)
+                self.add_event(when, 'recovery', peer)
+            when = start
+            while (peer.hostname is not None) and (ipchange_rate > 0):
+                when += self.rnd.expovariate(ipchange_rate / 3600)
+                if when >= start + duration:
+                    break
+                self.add_event(when, 'ipchange', peer)
+
+    def apply_events(self, now):
+        '''Applies all events up to the given time'''
+        while self.events and (self.events[0][0] <= now):
+            when, seq, kind, index = heapq.heappop(self.events)
+            peer = self.peers[index]
+            if kind == 'outage':
+                peer.down = True
+            elif kind == 'recovery':
+                peer.down = False
+            elif kind == 'ipchange':
+                peer.address = self.new_address()
+                self.dns[peer.hostname] = peer.address
+            for listener in self.listeners:
+                listener(when, kind, peer)
+
+    def is_reachable(self, peer):
+        '''Checks whether the tunnel to the peer can work'''
+        return (not peer.down) and (peer.endpoint == peer.address)
+
+    def dump(self, now):
+        '''Returns the output of "wg show all dump" for the current state'''
+        self.counters['wg-show'] += 1
+        now = int(now)
+        lines = []
+        for i, interface in enumerate(self.interfaces):
+            lines.append('{0}\tprivate{1}\tpublic{1}\t{2}\toff'.format(interface, i, 51820 + i))
+            for peer in self.peers_by_interface[interface]:
+                if self.is_reachable(peer):
+                    if now - peer.latest_handshake >= REKEY_AFTER_TIME:
+                        peer.latest_handshake = now
+                    peer.transfer_rx += 1000
+                    peer.transfer_tx += 1000
+                lines.append('{0}\t{1}\t(none)\t{2}:51820\t{3}/32\t{4}\t{5}\t{6}\t25'.format(interface, peer.key, peer.endpoint, peer.ping_address,
+                             peer.latest_handshake, peer.transfer_rx, peer.transfer_tx))
+        return '\n'.join(lines) + '\n'
+
+    def set_endpoint(self, interface, key, endpoint):
+        '''Sets the endpoint configured in WireGuard'''
+        peer = self.by_key.get((interface, key))
+        if peer is None:
+            return 'Peer not found'
+        peer.endpoint = endpoint.rpartition(':')[0]
+        self.counters['endpoints-set'] += 1
+        return None
+
+    def ping(self, destination):
+        '''Returns 0 if the peer with the given address answers'''
+        self.counters['pings'] += 1
+        peer = self.by_ping_address.get(destination)
+        return 0 if (peer is not None) and self.is_reachable(peer) else 1
+
+
+class SimulatedWireguard(wg_command.WireguardCommand):
+    '''WireGuard command replacement operating on the simulated network'''
+
+    def __init__(self, network, interface='all'):
+        '''Constructor'''
+        self.network = network
+        super().__init__(interface)
+
+    def execute_wg_show(self, suppressoutput=True, suppresserrors=False):
+        '''Returns the simulated dump'''
+        return self.network.dump(clock.time())
+
+    async def execute_wg_show_async(self, timeout=None, suppressoutput=True, suppresserrors=False):
+        '''Returns the simulated dump'''
+        return self.network.dump(clock.time())
+
+    async def execute_wg_set_peers_async(self, interface, attr, values, timeout=None):
+        '''Sets the endpoints in the simulated network; returns a dictionary of errors per peer'''
+        self.network.counters['wg-set'] += 1
+        errors = dict()
+        for peer, value in values.items():
+            error = self.network.set_endpoint(interface, peer, value) if attr == 'endpoint' else None
+            if error is not None:
+                errors[peer] = error
+        return errors
+
+
+class SimulatedDataKeeper(datakeeper.DataKeeper):
+    '''DataKeeper that uses the simulated network instead of the WireGuard command and config files'''
+
+    def __init__(self, config, network):
+        '''Constructor'''
+        self.network = network
+        super().__init__(config)
+
+    def initialize(self):
+        '''Initializes the data structures from the simulated network'''
+        self.wgcmd = SimulatedWireguard(self.network)
+        self.wgcmd.retrieve_wireguard_data()
+        self.data = self.wgcmd.data
+        for peer in self.network.peers:
+            if peer.hostname is not None:
+                self.data[peer.interface]['peers'][peer.key]['config_endpoint'] = peer.hostname + ':51820'
+        self.config_interfaces.update(self.get_interfaces()) # there are no config files to read
+
+
+class SimulatedPinger():
+    '''Pinger replacement operating on the simulated network'''
+
+    def __init__(self, network):
+        '''Constructor'''
+        self.network = network
+
+    async def ping(self, destination, interface, ping6=False):
+        '''Checks reachability in the simulated network; returns 0 on success'''
+        return self.network.ping(destination)
+
+    def close(self):
+        '''Nothing to close'''
+        pass
+
+
+class SimulatedResolver(resolver.Resolver):
+    '''Resolver (including its cache) that answers queries from the records of the simulated network'''
+
+    def __init__(self, network, ttl=60, **kwargs):
+        '''Constructor'''
+        self.network = network
+        self.ttl = ttl
+        super().__init__(nameservers=[], **kwargs)
+
+    async def lookup_builtin(self, hostname):
+        '''Returns the address of the hostname in the simulated network and the TTL'''
+        self.network.counters['dns-lookups'] += 1
+        address = self.network.dns.get(hostname)
+        return ([address] if address is not None else []), self.ttl
+
+    async def lookup_system(self, hostname):
+        '''There is no system resolver in the simulation'''
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+
+class Simulation():
+    '''Runs the event processor against a simulated network and measures its behaviour'''
+
+    def __init__(self, cfg, network, duration=86400, dns_ttl=60):
+        '''Constructor'''
+        self.cfg = cfg
+        self.network = network
+        self.duration = duration
+        self.dns_ttl = dns_ttl
+        self.clock = clock.VirtualClock()
+        self.detecting = dict() # peer index -> time of the outage (or IP change) not yet detected
+        self.recovering = dict() # peer index -> time from which the peer could be up again
+        self.latencies = { 'detection': [], 'recovery': [] }
+        self.cpu_times = []
+        self.polls = 0
+
+    def on_event(self, when, kind, peer):
+        '''Remembers the time of an event to measure how long it takes until the status reflects it'''
+        if kind in ['outage', 'ipchange']:
+            self.recovering.pop(peer.index, None)
+            if self.status(peer) == 'up:ok':
+                self.detecting.setdefault(peer.index, when)
+            if kind == 'ipchange':
+                self.recovering[peer.index] = when
+        elif kind == 'recovery':
+            self.recovering[peer.index] = when
+
+    def status(self, peer):
+        '''Returns the status of the simulated peer as determined by the logic'''
+        return self.data.get(peer.interface, peer.key, 'status')
+
+    def check_latencies(self, now):
+        '''Records the latencies of status changes that happened'''
+        for index, when in list(self.detecting.items()):
+            if self.status(self.network.peers[index]) != 'up:ok':
+                self.latencies['detection'].append(now - when)
+                del self.detecting[index]
+        for index, when in list(self.recovering.items()):
+            peer = self.network.peers[index]
+            if peer.down:
+                continue
+            if self.status(peer) == 'up:ok':
+                self.latencies['recovery'].append(now - when)
+                del self.recovering[index]
+                self.detecting.pop(index, None)
+
+    async def settle(self):
+        '''Lets the workers process the event queue (processing does not take virtual time)'''
+        for i in range(10000):
+            if (not any(queue.qsize() for queue in self.evt.queues)) and (self.evt.busy_workers == 0) \
+               and (not self.data.apply_lock.locked()) and (not self.data.pending_endpoints):
+                break
+            await asyncio.sleep(0)
+
+    async def run_async(self):
+        '''Runs the simulation'''
+        clock.set_clock(self.clock)
+        try:
+            start = self.clock.time()
+            self.network.listeners.append(self.on_event)
+            self.data = SimulatedDataKeeper(self.cfg, self.network)
+            self.evt = eventprocessor.EventProcessor(self.cfg, data=self.data)
+            logic = self.evt.logic
+            logic.pinger = SimulatedPinger(self.network)
+            logic.resolver = SimulatedResolver(self.network, ttl=self.dns_ttl)
+            self.data.stats['dns'] = logic.resolver.stats
+            finished = asyncio.Event()
+            do_periodically = logic.do_periodically
+
+            async def do_periodically_measured():
+                await self.settle()
+                now = self.clock.time()
+                self.check_latencies(now)
+                if now >= start + self.duration:
+                    finished.set()
+                    await asyncio.sleep(3600) # wait for being cancelled
+                self.network.apply_events(now)
+                cpu_start = time.process_time()
+                await do_periodically()
+                self.cpu_times.append(time.process_time() - cpu_start)
+                self.polls += 1
+
+            logic.do_periodically = do_periodically_measured
+            task = asyncio.ensure_future(self.evt.run_async())
+            await asyncio.wait([task, asyncio.ensure_future(finished.wait())], return_when=asyncio.FIRST_COMPLETED)
+            task.cancel()
+            for t in asyncio.all_tasks():
+                if t is not asyncio.current_task():
+                    t.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            if task.done() and not task.cancelled() and (task.exception() is not None):
+                raise task.exception()
+        finally:
+            clock.set_clock(None)
+        return self.report()
+
+    def run(self):
+        '''Runs the simulation; returns the report'''
+        return asyncio.run(self.run_async())
+
+    def report(self):
+        '''Returns the results of the simulation as dictionary'''
+        hours = self.duration / 3600
+
+        def summarize(values):
+            if not values:
+                return { 'count': 0 }
+            values = sorted(values)
+            return { 'count': len(values), 'mean': statistics.mean(values), 'median': statistics.median(values),
+                     'p95': values[int(0.95 * (len(values) - 1))], 'max': values[-1] }
+
+        return { 'peers': len(self.network.peers), 'hours': hours, 'polls': self.polls,
+                 'detection-latency': summarize(self.latencies['detection']), 'recovery-latency': summarize(self.latencies['recovery']),
+                 'undetected': len(self.detecting), 'unrecovered': len(self.recovering),
+                 'cycle-cpu': summarize(self.cpu_times), 'cpu-total': sum(self.cpu_times),
+                 'per-hour': { k: v / hours for k, v in self.network.counters.items() } }
+
+
+def usage():
+    """Show information on command line arguments"""
+    print('Usage: %s [-?|--help] [-c|--config <config file>] [-p|--peers <number>] [-i|--interfaces <number>] [-H|--hours <number>]' % sys.argv[0])
+    print('           [-o|--outages <rate>] [-d|--outage-duration <seconds>] [-a|--ipchanges <rate>] [-t|--ttl <seconds>] [-s|--seed <number>]')
+    print('Simulate WireGuard peers with outages and IP changes using a virtual clock')
+    print()
+    print('  -?, --help                        show program usage')
+    print('  -c, --config <config file>        wgtrack configuration file to use (outputs are written as configured)')
+    print('  -p, --peers <number>              number of peers (default: 1000)')
+    print('  -i, --interfaces <number>         number of interfaces (default: 4)')
+    print('  -H, --hours <number>              simulated time in hours (default: 24)')
+    print('  -o, --outages <rate>              outages per peer and hour (default: 0.01)')
+    print('  -d, --outage-duration <seconds>   average duration of outages (default: 600)')
+    print('  -a, --ipchanges <rate>            IP changes per peer with hostname and hour (default: 0.01)')
+    print('  -t, --ttl <seconds>               TTL of DNS records (default: 60)')
+    print('  -s, --seed <number>               seed of the random number generator (default: 1)')
+    print()
+
+def main():
+    '''Runs the simulation as specified on the command line and prints the results'''
+    settings = { 'peers': 1000, 'interfaces': 4, 'hours': 24.0, 'outages': 0.01, 'outage-duration': 600.0, 'ipchanges': 0.01, 'ttl': 60, 'seed': 1 }
+    configfile = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'c:p:i:H:o:d:a:t:s:?', ['help', 'config=', 'peers=', 'interfaces=', 'hours=', 'outages=',
+                                                                        'outage-duration=', 'ipchanges=', 'ttl=', 'seed='])
+        options = { '-p': 'peers', '-i': 'interfaces', '-H': 'hours', '-o': 'outages', '-d': 'outage-duration', '-a': 'ipchanges', '-t': 'ttl', '-s': 'seed' }
+        for o, a in opts:
+            if o in ('-?', '--help'):
+                usage()
+                sys.exit(0)
+            elif o in ('-c', '--config'):
+                configfile = a
+            else:
+                name = options.get(o, o[2:])
+                settings[name] = type(settings[name])(a)
+        if args:
+            raise getopt.GetoptError('unexpected command line arguments')
+    except (getopt.GetoptError, ValueError) as ex:
+        print(ex)
+        usage()
+        sys.exit(2)
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(module)s: %(message)s', level=logging.ERROR)
+    cfg = config.Config()
+    if configfile is not None:
+        cfg.read(configfile)
+    else:
+        cfg.read_dict({ 'general': { 'configfile': '' } })
+    cfg['general']['state_file'] = '' # neither continue with nor overwrite the state of a real instance
+    cfg['general']['control_socket'] = '' # do not replace the control socket of a real instance
+    network = SimulatedNetwork(settings['peers'], settings['interfaces'], seed=settings['seed'])
+    duration = settings['hours'] * 3600
+    network.script_events(clock.VirtualClock().time(), duration, settings['outages'], settings['outage-duration'], settings['ipchanges'])
+    started = time.perf_counter()
+    result = Simulation(cfg, network, duration, settings['ttl']).run()
+    print('Simulated {hours:.1f}h of {peers} peers with {polls} polls in {seconds:.1f}s'.format(seconds=time.perf_counter() - started, **result))
+    for name in ['detection-latency', 'recovery-latency', 'cycle-cpu']:
+        values = result[name]
+        if values['count'] == 0:
+            print('{0:<18} none'.format(name))
+        else:
+            print('{0:<18} count {count}, mean {mean:.3f}s, median {median:.3f}s, p95 {p95:.3f}s, max {max:.3f}s'.format(name, **values))
+    print('{0:<18} {1} not detected, {2} not recovered at the end'.format('pending', result['undetected'], result['unrecovered']))
+    print('{0:<18} {1}'.format('per hour', ', '.join('{0} {1:.1f}'.format(k, v) for k, v in result['per-hour'].items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Compact binary snapshot of the tracking state of the peers (for continuing where a previous instance stopped)"""
+
+import binascii
+import collections
+import struct
+import zlib
+
+
+MAGIC = b'WGTS'
+VERSION = 1
+STATUSES = ['undefined', 'up:ok', 'down:waiting', 'down:checking', 'down:backingoff', 'down:slowchecking', 'down', 'disabled']
+FLAG_BACKINGOFF = 0x01 # backing-off limit set
+FLAG_ENDPOINT = 0x02 # endpoint hostname configured (its checksum is valid)
+FLAG_TRANSFER = 0x04 # transfer counters of the previous check known
+FLAG_HANDSHAKE = 0x08 # latest handshake of the previous check known
+
+HEADER = struct.Struct('<4sHdII') # magic, version, time saved (seconds since the epoch), number of interfaces, number of DNS cache entries
+INTERFACE = struct.Struct('<HI') # length of name, number of peers (followed by the name)
+PEER = struct.Struct('<32sBBiiHIQQQ') # public key, status, flags, cycle counter, backing-off limit, ping fail counter, checksum of configured endpoint,
+                                      # received bytes, transmitted bytes, and latest handshake at the previous check
+DNS_ENTRY = struct.Struct('<HdH') # length of hostname, expiry (seconds since the epoch), number of addresses (followed by the hostname and the addresses)
+ADDRESS = struct.Struct('<B') # length of address (followed by the address)
+TRAILER = struct.Struct('<I') # checksum of everything before
+
+PeerState = collections.namedtuple('PeerState', ['status', 'cycle_counter', 'backingoff_limit', 'ping_failcounter', 'endpoint_checksum', 'transfer_previous'])
+
+
+def get_endpoint_checksum(config_endpoint):
+    '''Returns a checksum of the configured endpoint (to notice config changes while not running)'''
+    return None if config_endpoint is None else zlib.crc32(config_endpoint.encode('utf-8'))
+
+def encode_key(peer):
+    '''Returns the public key of a peer as 32 bytes (None if it is not a valid key)'''
+    try:
+        key = binascii.a2b_base64(peer)
+    except binascii.Error:
+        return None
+    return key if len(key) == 32 else None
+
+def pack(saved, interfaces, dns_cache):
+    '''Returns the snapshot as bytes; "interfaces" maps interface names to dictionaries of peer -> PeerState,
+       "dns_cache" maps hostnames to tuples of expiry (seconds since the epoch) and list of addresses'''
+    parts = [HEADER.pack(MAGIC, VERSION, saved, len(interfaces), len(dns_cache))]
+    for interface, peers in interfaces.items():
+        name = interface.encode('utf-8')
+        records = []
+        for peer, state in peers.items():
+            key = encode_key(peer)
+            if (key is None) or (state.status not in STATUSES):
+                continue
+            flags = 0
+            backingoff_limit = state.backingoff_limit
+            if backingoff_limit is not None:
+                flags |= FLAG_BACKINGOFF
+            endpoint_checksum = state.endpoint_checksum
+            if endpoint_checksum is not None:
+                flags |= FLAG_ENDPOINT
+            transfer_rx = transfer_tx = latest_handshake = 0
+            if (state.transfer_previous is not None) and (state.transfer_previous[0] is not None) and (state.transfer_previous[1] is not None):
+                flags |= FLAG_TRANSFER
+                transfer_rx, transfer_tx, latest_handshake = state.transfer_previous
+                if latest_handshake is not None:
+                    flags |= FLAG_HANDSHAKE
+                else:
+                    latest_handshake = 0
+            records.append(PEER.pack(key, STATUSES.index(state.status), flags, state.cycle_counter, backingoff_limit or 0,
+                                     min(state.ping_failcounter, 0xffff), endpoint_checksum or 0, transfer_rx, transfer_tx, latest_handshake))
+        parts.append(INTERFACE.pack(len(name), len(records)))
+        parts.append(name)
+        parts.extend(records)
+    for hostname, (expiry, addresses) in dns_cache.items():
+        name = hostname.encode('utf-8')
+        parts.append(DNS_ENTRY.pack(len(name), expiry, len(addresses)))
+        parts.append(name)
+        for address in addresses:
+            address = address.encode('ascii')
+            parts.append(ADDRESS.pack(len(address)))
+            parts.append(address)
+    content = b''.join(parts)
+    return content + TRAILER.pack(zlib.crc32(content))
+
+def unpack(content):
+    '''Returns the time saved, the state of the peers (interface -> peer -> PeerState), and the DNS cache (hostname -> (expiry, addresses));
+       raises ValueError if the snapshot is invalid'''
+    if (len(content) < HEADER.size + TRAILER.size) or (TRAILER.unpack_from(content, len(content) - TRAILER.size)[0] != zlib.crc32(content[:-TRAILER.size])):
+        raise ValueError('snapshot truncated or corrupted')
+    try:
+        magic, version, saved, interface_count, dns_count = HEADER.unpack_from(content, 0)
+        if (magic != MAGIC) or (version != VERSION):
+            raise ValueError('unsupported snapshot format')
+        offset = HEADER.size
+        interfaces = dict()
+        for i in range(interface_count):
+            length, peer_count = INTERFACE.unpack_from(content, offset)
+            offset += INTERFACE.size
+            interface = content[offset:offset + length].decode('utf-8')
+            offset += length
+            peers = interfaces[interface] = dict()
+            for key, status, flags, cycle_counter, backingoff_limit, ping_failcounter, endpoint_checksum, transfer_rx, transfer_tx, latest_handshake \
+                    in PEER.iter_unpack(content[offset:offset + peer_count * PEER.size]):
+                peer = binascii.b2a_base64(key, newline=False).decode('ascii')
+                transfer_previous = None
+                if flags & FLAG_TRANSFER:
+                    transfer_previous = (transfer_rx, transfer_tx, latest_handshake if flags & FLAG_HANDSHAKE else None)
+                peers[peer] = PeerState(STATUSES[status], cycle_counter, backingoff_limit if flags & FLAG_BACKINGOFF else None, ping_failcounter,
+                                        endpoint_checksum if flags & FLAG_ENDPOINT else None, transfer_previous)
+            offset += peer_count * PEER.size
+        dns_cache = dict()
+        for i in range(dns_count):
+            length, expiry, address_count = DNS_ENTRY.unpack_from(content, offset)
+            offset += DNS_ENTRY.size
+            hostname = content[offset:offset + length].decode('utf-8')
+            offset += length
+            addresses = []
+            for j in range(address_count):
+                length = ADDRESS.unpack_from(content, offset)[0]
+                offset += ADDRESS.size
+                addresses.append(content[offset:offset + length].decode('ascii'))
+                offset += length
+            dns_cache[hostname] = (expiry, addresses)
+    except (struct.error, IndexError, UnicodeError) as e:
+        raise ValueError('invalid snapshot: {0}'.format(e)) from None
+    return saved, interfaces, dns_cache
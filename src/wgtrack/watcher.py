@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""Watcher for changes of config files using inotify (Linux) within the asyncio event loop"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+
+logger = logging.getLogger(__name__);
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE # file written completely, renamed (atomic replace), or deleted
+EVENT_HEADER = struct.Struct('iIII') # watch descriptor, mask, cookie, length of name
+
+
+class Watcher():
+    '''Watches files via inotify and reports changed files in batches once writing has calmed down'''
+
+    def __init__(self, loop, callback, debounce=0.5, max_delay=5):
+        '''Constructor; "callback" is called with a set of changed paths (or None if events were lost) "debounce" seconds after the last change'''
+        self.loop = loop
+        self.callback = callback
+        self.debounce = debounce
+        self.max_delay = max_delay # changes are reported at the latest after this time even if writing goes on
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch # raises AttributeError if inotify is not available
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.directories = dict() # watch descriptor -> tuple of directory, names of interest (None: all), and suffix of names of interest
+        self.pending = set() # paths changed since the last report
+        self.overflow = False # events lost; everything needs to be checked
+        self.first_change = None # time of the first change not reported yet
+        self.timer = None
+        self.loop.add_reader(self.fd, self.read_events)
+
+    def watch(self, directory, names=None, suffix=''):
+        '''Watches the given files (or all files with the given suffix) in the given directory'''
+        wd = self.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        known = self.directories.get(wd)
+        if (known is not None) and (names is not None) and (known[1] is not None): # several files in the same directory
+            names = set(names) | known[1]
+        self.directories[wd] = (directory, None if names is None else set(names), suffix)
+        logger.debug('Watching [{0}] for changes'.format(directory))
+
+    def close(self):
+        '''Stops watching'''
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.fd >= 0:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = -1
+
+    def read_events(self):
+        '''Reads the pending events (called by the event loop when the inotify file descriptor is readable)'''
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            directory, names, suffix = directory
+            if ((names is None) or (name in names)) and name.endswith(suffix):
+                self.pending.add(os.path.join(directory, name))
+        if self.pending or self.overflow:
+            self.schedule()
+
+    def schedule(self):
+        '''(Re)starts the timer for reporting the changes'''
+        now = self.loop.time()
+        if self.first_change is None:
+            self.first_change = now
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = min(self.debounce, max(0, self.first_change + self.max_delay - now))
+        self.timer = self.loop.call_later(delay, self.report)
+
+    def report(self):
+        '''Reports the changed files'''
+        paths = None if self.overflow else self.pending
+        self.pending, self.overflow, self.first_change, self.timer = set(), False, None, None
+        try:
+            self.callback(paths)
+        except Exception as e:
+            logger.error('Processing changed config files failed: [{0}]'.format(e))
@@ -3,12 +3,16 @@
 """Class that uses the 'wg show' command to get the status of WireGuard as Python dictionaries"""
 
 
+import asyncio
 import collections
+import itertools
 import logging
 import pprint
 import shlex
 import subprocess
-import time
+
+from . import clock
+from . import peerrecord
 
 
 logger = logging.getLogger(__name__);
@@ -20,19 +24,28 @@ class WireguardCommand():
     def __init__(self, interface='all'):
         '''Constructor'''
         self.interface = interface
+        self.handshake_changes = set() # peers whose handshake status changed (or that are new)
+        self.columns = None # optional columnar store for evaluating all peers at once
+        self.changed_peers = set() # peers whose line in the dump changed in the last parsing (or that are new)
+        self.previous_lines = [] # lines of the previous dump
+        self.previous_keys = [] # tuple of interface and peer for each line of the previous dump (None for interface lines)
+        self.previous_records = [] # record of the peer for each line of the previous dump (kept apart from the keys for less garbage collection work)
+        self.previous_data = None # data the records in "previous_records" belong to
         self.clear_data()
 
     def clear_data(self):
         '''Clears all data so that it can be set anew'''
         self.data = collections.defaultdict(dict)
 
-    def check_handshake(self, latest_handshake, persistent_keepalive):
+    def check_handshake(self, latest_handshake, persistent_keepalive, now=None):
         '''Checks whether handshake succeeded as expected'''
         if latest_handshake == 0: # no handshake took place successfully yet
             return None, 'none'
         if persistent_keepalive == None: # convert this parameter to an integer
             persistent_keepalive = 0
-        delta = int(time.time()) - latest_handshake # delta in seconds
+        if now is None:
+            now = clock.time()
+        delta = int(now) - latest_handshake # delta in seconds
         # Based on a forum: 2 minutes + keepalive + 2s (error margin)
         # However, this does not seem to match https://www.wireguard.com/papers/wireguard.pdf
         if delta <= 120:
@@ -60,6 +73,25 @@ class WireguardCommand():
         nsp.wait();
         return out, err;
 
+    async def execute_async(self, command, timeout=None, suppressoutput=False, suppresserrors=False):
+        '''Execute a command asynchronously (the process is killed on timeout or cancellation)'''
+        args = shlex.split(command)
+        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        err = err.decode('utf8')
+        if not suppresserrors and (len(err) > 0):
+            logger.error(err)
+        out = out.decode('utf8')
+        if not suppressoutput and (len(out) > 0):
+            print(out)
+        return out, err
+
     def execute_wg_set(self, interface, peer, attr, value, suppressoutput=True, suppresserrors=False):
         '''Execute the WireGuard command to set the provided attribute'''
         command = 'wg set "{0}"'.format(interface)
@@ -76,6 +108,25 @@ class WireguardCommand():
             logger.error('Exception when execution WireGuard set command failed: [{0}]'.format(e))
         return None
 
+    async def execute_wg_set_peers_async(self, interface, attr, values, timeout=None):
+        '''Sets the provided attribute of several peers with one WireGuard command; returns a dictionary of errors per peer'''
+        command = 'wg set "{0}"'.format(interface)
+        for peer, value in values.items():
+            command += ' peer "{0}" {1} "{2}"'.format(peer, attr, value)
+        try:
+            out, err = await self.execute_async(command, timeout, suppressoutput=True, suppresserrors=True)
+        except Exception as e:
+            err = 'Exception when executing WireGuard set command: [{0}]'.format(e)
+        if len(err) == 0:
+            return dict()
+        if len(values) == 1:
+            return { peer: err.strip() for peer in values }
+        # The command stops at the first failing peer; thus set the peers one by one to get the error of each peer
+        errors = dict()
+        for peer, value in values.items():
+            errors.update(await self.execute_wg_set_peers_async(interface, attr, { peer: value }, timeout))
+        return errors
+
     def execute_wg_show(self, suppressoutput=True, suppresserrors=False):
         '''Return the output of "wg show <if> all"'''
         try:
@@ -87,13 +138,47 @@ class WireguardCommand():
         except FileNotFoundError:
             logger.error('WireGuard command not found in search path. Is WireGuard installed on this system?')
         return None
-        
+
+    async def execute_wg_show_async(self, timeout=None, suppressoutput=True, suppresserrors=False):
+        '''Return the output of "wg show <if> all" without blocking the event loop'''
+        try:
+            out, err = await self.execute_async('wg show {0} dump'.format(self.interface), timeout, suppressoutput, suppresserrors)
+            if len(err) > 0:
+                logger.error('Error executing WireGuard command: {0}'.format(err))
+            else:
+                return out
+        except FileNotFoundError:
+            logger.error('WireGuard command not found in search path. Is WireGuard installed on this system?')
+        except asyncio.TimeoutError:
+            logger.error('WireGuard command did not finish within {0}s; keeping previous status'.format(timeout))
+        return None
+
     def parse_wg_output(self, output):
-        '''Parses the given output of the WireGuard command and stores it'''
+        '''Parses the given output of the WireGuard command and stores it (only peer lines that changed since the previous parsing are parsed)'''
         if output is None:
             return
+        now = clock.time()
+        columns = self.columns
+        keys, records = [], [] # peers in dump order for the columnar store
+        lines = output.splitlines()
+        if (self.previous_data is self.data) and (len(lines) == len(self.previous_lines)): # same peers in the same order as before (most likely)
+            previous = zip(self.previous_lines, self.previous_keys, self.previous_records)
+        else: # all lines need to be parsed
+            previous = itertools.repeat((None, None, None))
+        peer_keys, peer_records = [], []
+        changed = set()
         previous_interface = ''
-        for line in output.splitlines():
+        for line, (previous_line, key, record) in zip(lines, previous):
+            if (key is not None) and (line == previous_line): # peer line unchanged: only the handshake age needs to be updated
+                record.timestamp = now
+                if columns is None:
+                    self.classify_handshake(key[0], key[1], record, now)
+                else:
+                    keys.append(key)
+                    records.append(record)
+                peer_keys.append(key)
+                peer_records.append(record)
+                continue
             items = [item for item in line.split('\t')]
             if self.interface == 'all':
                 interface = items.pop(0)
@@ -109,21 +194,68 @@ class WireguardCommand():
                     items['private-key'] = None
                 if items['public-key'] == '(none)':
                     items['public-key'] = None
-                self.data[interface] = {**self.data.get(interface, dict()), **items} # merge dictionaries
-                self.data[interface]['peers'] = self.data[interface].get('peers', dict()) # make sure that peers dictionary exists
+                self.store_interfacedata(interface, items)
+                peer_keys.append(None)
+                peer_records.append(None)
             else: # peer
-                peer = items.pop(0)
-                peerdata = dict(zip(['preshared-key', 'endpoint', 'allowed-ips', 'latest-handshake', 'transfer-rx', 'transfer-tx', 'persistent-keepalive'], items))
-                peerdata['allowed-ips'] = peerdata['allowed-ips'].split(',')
-                if peerdata['preshared-key'] == '(none)':
-                    peerdata['preshared-key'] = None
-                if peerdata['persistent-keepalive'] == 'off':
-                    peerdata['persistent-keepalive'] = None
-                peerdata = { k: int(v) if (k in ['latest-handshake', 'transfer-rx', 'transfer-tx', 'persistent-keepalive']) and (v is not None) else v
-                             for k, v in peerdata.items() } # numeric strings to integer
-                peerdata['latest-handshake-seconds'], peerdata['handshake-status'] = self.check_handshake(peerdata['latest-handshake'], peerdata['persistent-keepalive'])    
-                peerdata['timestamp'] = time.time()
-                self.data[interface]['peers'][peer] = {**self.data[interface]['peers'].get(peer, dict()), **peerdata} # merge dictionaries
+                record = self.store_peerline(interface, items, now, classify=(columns is None))
+                key = (interface, items[0])
+                changed.add(key)
+                peer_keys.append(key)
+                peer_records.append(record)
+                if columns is not None:
+                    keys.append(key)
+                    records.append(record)
+        self.previous_lines, self.previous_keys, self.previous_records, self.previous_data = lines, peer_keys, peer_records, self.data
+        self.changed_peers = changed
+        if columns is not None:
+            self.handshake_changes.update(columns.evaluate(keys, records, now))
+
+    def get_record(self, interface, peer):
+        '''Returns the record of the given peer (created if needed)'''
+        peers = self.data[interface]['peers']
+        record = peers.get(peer)
+        if not isinstance(record, peerrecord.PeerRecord):
+            record = peerrecord.PeerRecord(record) # also takes over data from config files
+            peers[peer] = record
+        return record
+
+    def store_peerline(self, interface, items, now, classify=True):
+        '''Stores the attributes of a peer given as items of a dump line in its record (updated in place); returns the record'''
+        # Items: public key, preshared key, endpoint, allowed ips, latest handshake, transfer rx, transfer tx, persistent keepalive
+        record = self.get_record(interface, items[0])
+        record.preshared_key = None if items[1] == '(none)' else items[1]
+        record.endpoint = items[2]
+        record.set_allowed_ips(items[3])
+        record.latest_handshake = int(items[4])
+        record.transfer_rx = int(items[5])
+        record.transfer_tx = int(items[6])
+        record.persistent_keepalive = None if items[7] == 'off' else int(items[7])
+        record.timestamp = now
+        if classify: # otherwise done by the columnar store for all peers at once
+            self.classify_handshake(interface, items[0], record, now)
+        return record
+
+    def classify_handshake(self, interface, peer, record, now):
+        '''Updates the handshake age and status of the peer record; remembers the peer if its status changed'''
+        previous = getattr(record, 'handshake_status', None)
+        record.latest_handshake_seconds, record.handshake_status = self.check_handshake(record.latest_handshake, record.persistent_keepalive, now)
+        if previous != record.handshake_status:
+            self.handshake_changes.add((interface, peer))
+
+    def store_interfacedata(self, interface, items):
+        '''Merges the given attributes of an interface into the data tree'''
+        self.data[interface] = {**self.data.get(interface, dict()), **items} # merge dictionaries
+        self.data[interface]['peers'] = self.data[interface].get('peers', dict()) # make sure that peers dictionary exists
+
+    def store_peerdata(self, interface, peer, peerdata):
+        '''Merges the given attributes of a peer into the data tree (adds derived handshake information)'''
+        peerdata['latest-handshake-seconds'], peerdata['handshake-status'] = self.check_handshake(peerdata['latest-handshake'], peerdata['persistent-keepalive'])
+        peerdata['timestamp'] = clock.time()
+        record = self.get_record(interface, peer)
+        if record.get('handshake-status') != peerdata['handshake-status']:
+            self.handshake_changes.add((interface, peer))
+        record.update(peerdata)
 
     def retrieve_wireguard_data(self, data=None):
         '''Sets the local data based on output of WireGuard command to be executed'''
@@ -134,6 +266,15 @@ class WireguardCommand():
             self.data = data
         self.parse_wg_output(output)
 
+    async def retrieve_wireguard_data_async(self, data=None, timeout=None):
+        '''Sets the local data based on output of WireGuard command to be executed asynchronously'''
+        output = await self.execute_wg_show_async(timeout)
+        if data is None:
+            self.clear_data()
+        else:
+            self.data = data
+        self.parse_wg_output(output)
+
     @property
     def wgdata():
         return self.data
@@ -3,13 +3,28 @@
 """Class that parses the Wireguard configuration files as Python dictionaries"""
 
 import collections
+import json
 import logging
 import os
 import pprint
+import time
+
+from . import atomicwrite
 
 
 logger = logging.getLogger(__name__);
 
+SECRET_KEYS = ('private-key', 'presharedkey') # attributes of the config files not needed for tracking that must not be written to the config cache
+
+
+def strip_secrets(config, prefix=''):
+    '''Removes the secret keys from the parsed config of an interface (in place) and returns it'''
+    if config is not None:
+        for section in [config, *config.get('peers', dict()).values()]:
+            for key in SECRET_KEYS:
+                section.pop(prefix + key, None)
+    return config
+
 
 class WireguardConfig():
     '''Class for parsing the WireGuard config files'''
@@ -25,53 +40,52 @@ class WireguardConfig():
         
     def parse_wg_config(self, interface, prefix=''):
         '''Parses the given WireGuard config and stores it'''
-        
-        def section2dict(section_lines, prefix):
-            '''Converts the lines of a section into a dictionary'''
-            result = dict()
-            for line in section_lines:
-                k,_, v = line.partition('=')
+        with open(os.path.join(self.configpath, interface+'.conf'), 'r') as file:
+            self.parse_wg_config_lines(interface, file, prefix)
+
+    def parse_wg_config_lines(self, interface, lines, prefix=''):
+        '''Parses the given lines of a WireGuard config in a single pass and stores the result'''
+        # Note: ConfigParser cannot be used since it does not support duplicate "[Peer]" sections; thus do it ourselves
+        renamed = { 'allowedips': 'allowed-ips', 'persistentkeepalive': 'persistent-keepalive', 'privatekey': 'private-key', 'publickey': 'public-key' }
+        section = None # attributes of the current section (None before the first section)
+        section_isinterface = False
+
+        def store_section():
+            '''Stores the attributes of the section just completed'''
+            if section_isinterface:
+                self.data[interface] = {**section, **self.data[interface]} # merge dictionaries
+                self.data[interface]['peers'] = self.data[interface].get('peers', dict())
+            else:
+                k = section.get(prefix + 'public-key', '[PublicKey missing]')
+                peers = self.data[interface].setdefault('peers', dict())
+                peerdata = peers.get(k)
+                if peerdata is None:
+                    peers[k] = section
+                else: # merge in place; existing values take precedence
+                    for key, value in section.items():
+                        peerdata.setdefault(key, value)
+
+        for line in lines:
+            line = line.strip()
+            if (not line) or (line[0] in ';#'): # skip comments, empty lines, etc.
+                continue
+            if line[0] == '[':
+                if section is not None: # nothing to do on start of first section
+                    store_section()
+                section = dict()
+                section_isinterface = (line.lower() == '[interface]')
+            elif section is not None:
+                k, _, v = line.partition('=')
                 k = k.strip().lower()
                 v = v.strip()
                 if k == 'allowedips':
-                    k = 'allowed-ips'
                     v = v.replace(' ', '').split(',')
-                elif k == 'persistentkeepalive':
-                    k = 'persistent-keepalive'
-                elif k == 'preshared-key':
-                    k = 'preshared-key'
-                elif k == 'privatekey':
-                    k = 'private-key'
-                elif k == 'publickey':
-                    k = 'public-key'
-                v = int(v) if k in ['persistent-keepalive'] else v # convert strings to integers for certain attributes
-                result[prefix + k] = v
-            return result
-        
-        # Note: ConfigParser cannot be used since it does not support duplicate "[Peer]" sections; thus do it ourselves
-        with open(os.path.join(self.configpath, interface+'.conf'), 'r') as file:
-            config = file.readlines()
-        config = [ line.strip() for line in config ] # strip newlines, etc.
-        config = [ line for line in config if (len(line)>0) and (line[0] not in [';', '#']) ] # strip comments, empty lines, etc.
-        config = [ line if line[0] != '[' else line.lower() for line in config ] # section names to lower case
-        config.append('[eof]')
-        section_isinterface = None
-        section_lines = []
-        for line in config:
-            if line[0] == '[':
-                if section_isinterface is not None: # nothing to do on start of first section
-                    d = section2dict(section_lines, prefix)
-                    if section_isinterface:
-                        self.data[interface] = {**d, **self.data[interface]} # merge dictionaries
-                        self.data[interface]['peers'] = self.data[interface].get('peers', dict())
-                    else:
-                        k = d.get(prefix + 'public-key', '[PublicKey missing]')
-                        self.data[interface]['peers'][k] = {**d, **self.data[interface]['peers'].get(k, dict())} # merge dictionaries
-                # Prepare for reading section further
-                section_isinterface = (line == '[interface]')
-                section_lines = []
-            else:
-                section_lines.append(line)
+                k = renamed.get(k, k)
+                if k == 'persistent-keepalive': # convert strings to integers for certain attributes
+                    v = int(v)
+                section[prefix + k] = v
+        if section is not None:
+            store_section()
 
     def retrieve_wireguard_config(self, interfaces, data=None, prefix=''):
         '''Sets the local data based on parsed WireGuard config files'''
@@ -102,6 +116,65 @@ class WireguardConfig():
         return self.data.get(interface, dict()).get('peers')
 
 
+class ConfigCache():
+    '''Cache of parsed WireGuard config files (stored as JSON file); an entry is only used while path, modification time, and size of the file match'''
+    VERSION = 2 # to be increased whenever the result of parsing changes
+    RACY_SECONDS = 2 # files modified more recently are not cached as a change within the timestamp granularity could go unnoticed
+
+    def __init__(self, filename):
+        '''Constructor'''
+        self.filename = filename
+        self.entries = dict() # path -> dictionary with modification time, size, content hash (hex), prefix, and parsed data
+        self.modified = False
+        self.hits = 0
+        self.load()
+
+    def load(self):
+        '''Reads the cache file (a missing or invalid file results in an empty cache)'''
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                content = json.load(f)
+            if content.get('version') == self.VERSION:
+                self.entries = content.get('files', dict())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning('Ignoring config cache [{0}] that cannot be read: [{1}]'.format(self.filename, e))
+
+    def save(self, paths=None):
+        '''Writes the cache file if it changed; only entries of the given paths are kept (all if not given)'''
+        if paths is not None:
+            paths = set(paths)
+            for path in self.entries.keys() - paths: # files no longer of interest
+                del self.entries[path]
+                self.modified = True
+        if not self.modified:
+            return
+        try:
+            with atomicwrite.open_for_atomic_write(self.filename) as f:
+                f.write(json.dumps({ 'version': self.VERSION, 'files': self.entries }, separators=(',', ':'))) # much faster than json.dump writing in pieces
+            self.modified = False
+        except OSError as e:
+            logger.warning('Writing config cache [{0}] failed: [{1}]'.format(self.filename, e))
+
+    def get(self, path, info, prefix):
+        '''Returns content hash and parsed data of the given file if cached and still current (None otherwise); "info" is the result of stat'''
+        entry = self.entries.get(path)
+        if (entry is None) or (entry.get('mtime_ns') != info.st_mtime_ns) or (entry.get('size') != info.st_size) or (entry.get('prefix') != prefix):
+            return None
+        self.hits += 1
+        return bytes.fromhex(entry['digest']), entry['data']
+
+    def put(self, path, info, prefix, digest, data):
+        '''Stores the parsed data of the given file ("info" is the result of stat before reading it)'''
+        if info.st_mtime_ns > (time.time() - self.RACY_SECONDS) * 1e9: # just modified; might be modified again unnoticed
+            if self.entries.pop(path, None) is not None:
+                self.modified = True
+            return
+        self.entries[path] = { 'mtime_ns': info.st_mtime_ns, 'size': info.st_size, 'digest': digest.hex(), 'prefix': prefix, 'data': data }
+        self.modified = True
+
+
 if __name__ == '__main__':
     wg = WireguardConfig()
     wg.retrieve_wireguard_config(['wg_1'])
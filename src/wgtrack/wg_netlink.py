@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+"""Class that queries the status of WireGuard via generic netlink (WG_CMD_GET_DEVICE) as Python dictionaries"""
+
+import asyncio
+import base64
+import errno
+import logging
+import os
+import pprint
+import socket
+import struct
+
+from . import wg_command
+
+
+logger = logging.getLogger(__name__);
+
+# Netlink constants (see linux/netlink.h and linux/genetlink.h)
+NETLINK_GENERIC = 16
+NLM_F_REQUEST = 0x01
+NLM_F_MULTI = 0x02
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x02
+NLMSG_DONE = 0x03
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3fff
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+# WireGuard constants (see linux/wireguard.h)
+WG_GENL_NAME = 'wireguard'
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WGDEVICE_A_IFINDEX = 1
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PRIVATE_KEY = 3
+WGDEVICE_A_PUBLIC_KEY = 4
+WGDEVICE_A_FLAGS = 5
+WGDEVICE_A_LISTEN_PORT = 6
+WGDEVICE_A_FWMARK = 7
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_FLAGS = 3
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL = 5
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+WGPEER_A_PROTOCOL_VERSION = 10
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+
+NLMSGHDR = struct.Struct('=IHHII')
+GENLMSGHDR = struct.Struct('=BBH')
+NLATTR = struct.Struct('=HH')
+EMPTY_KEY = bytes(32)
+
+
+class NetlinkError(OSError):
+    '''Error reported by the kernel in a netlink message'''
+    pass
+
+
+def align(length):
+    '''Returns the given length aligned to the netlink attribute boundary of four bytes'''
+    return (length + 3) & ~3
+
+def pack_attr(attrtype, payload):
+    '''Encodes a netlink attribute'''
+    length = NLATTR.size + len(payload)
+    return NLATTR.pack(length, attrtype) + payload + bytes(align(length) - length)
+
+def pack_message(msgtype, flags, seq, cmd, version, payload, pid=0):
+    '''Encodes a generic netlink message'''
+    payload = GENLMSGHDR.pack(cmd, version, 0) + payload
+    return NLMSGHDR.pack(NLMSGHDR.size + len(payload), msgtype, flags, seq, pid) + payload
+
+def unpack_attrs(buffer, offset=0, end=None):
+    '''Decodes the netlink attributes in the given buffer (as a generator of type and payload)'''
+    if end is None:
+        end = len(buffer)
+    while offset + NLATTR.size <= end:
+        length, attrtype = NLATTR.unpack_from(buffer, offset)
+        if length < NLATTR.size:
+            break
+        yield attrtype & NLA_TYPE_MASK, buffer[offset + NLATTR.size:offset + length]
+        offset += align(length)
+
+def unpack_messages(buffer):
+    '''Decodes the netlink messages in the given buffer (as a generator of type, flags, seq, and payload)'''
+    offset = 0
+    while offset + NLMSGHDR.size <= len(buffer):
+        length, msgtype, flags, seq, pid = NLMSGHDR.unpack_from(buffer, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield msgtype, flags, seq, buffer[offset + NLMSGHDR.size:offset + length]
+        offset += align(length)
+
+def format_key(key):
+    '''Returns the base64 representation of a key as used by the "wg" command'''
+    return base64.b64encode(key).decode('ascii')
+
+def format_sockaddr(sockaddr):
+    '''Returns the textual representation of a sockaddr structure as used by the "wg" command'''
+    family = struct.unpack_from('=H', sockaddr)[0]
+    if family == socket.AF_INET:
+        port = struct.unpack_from('!H', sockaddr, 2)[0]
+        return '{0}:{1}'.format(socket.inet_ntop(socket.AF_INET, bytes(sockaddr[4:8])), port)
+    if family == socket.AF_INET6:
+        port = struct.unpack_from('!H', sockaddr, 2)[0]
+        address = socket.inet_ntop(socket.AF_INET6, bytes(sockaddr[8:24]))
+        scope_id = struct.unpack_from('=I', sockaddr, 24)[0]
+        if scope_id:
+            try:
+                address += '%' + socket.if_indextoname(scope_id)
+            except OSError:
+                address += '%' + str(scope_id)
+        return '[{0}]:{1}'.format(address, port)
+    return None
+
+def open_netlink_socket():
+    '''Opens a generic netlink socket'''
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+    sock.bind((0, 0))
+    return sock
+
+def list_interfaces():
+    '''Returns the names of all network interfaces of the system'''
+    return [ name for index, name in socket.if_nameindex() ]
+
+
+class WireguardNetlink(wg_command.WireguardCommand):
+    '''Class for querying WireGuard's status via generic netlink (falls back to the "wg" command if unavailable)'''
+
+    def __init__(self, interface='all', socket_factory=None, interface_lister=None):
+        '''Constructor'''
+        self.socket_factory = socket_factory or open_netlink_socket
+        self.interface_lister = interface_lister or list_interfaces
+        self.fallback = False
+        self.seq = 0
+        super().__init__(interface)
+
+    def request(self, sock, msgtype, flags, cmd, version, payload):
+        '''Sends a request and returns the payloads of all response messages (raises NetlinkError on error)'''
+        self.seq = (self.seq + 1) & 0xffffffff
+        sock.send(pack_message(msgtype, flags, self.seq, cmd, version, payload))
+        responses = []
+        while True:
+            done = True
+            for msgtype, msgflags, seq, payload in unpack_messages(sock.recv(65536)):
+                if seq != self.seq: # ignore stale messages
+                    done = False
+                    continue
+                if msgtype == NLMSG_ERROR:
+                    error = struct.unpack_from('=i', payload)[0]
+                    if error < 0:
+                        raise NetlinkError(-error, os.strerror(-error))
+                    return responses # acknowledgement
+                if msgtype == NLMSG_DONE:
+                    error = struct.unpack_from('=i', payload)[0] if len(payload) >= 4 else 0
+                    if error < 0:
+                        raise NetlinkError(-error, os.strerror(-error))
+                    return responses
+                responses.append(payload[GENLMSGHDR.size:])
+                done = not (msgflags & NLM_F_MULTI)
+            if done and responses:
+                return responses
+
+    def resolve_family(self, sock):
+        '''Returns the generic netlink family id of WireGuard'''
+        payload = pack_attr(CTRL_ATTR_FAMILY_NAME, WG_GENL_NAME.encode('ascii') + b'\0')
+        for response in self.request(sock, GENL_ID_CTRL, NLM_F_REQUEST, CTRL_CMD_GETFAMILY, 1, payload):
+            for attrtype, value in unpack_attrs(response):
+                if attrtype == CTRL_ATTR_FAMILY_ID:
+                    return struct.unpack_from('=H', value)[0]
+        raise NetlinkError(errno.ENOENT, 'WireGuard netlink family not found')
+
+    def parse_peer(self, buffer, peerdata):
+        '''Parses the netlink attributes of a peer into the given dictionary; returns the public key'''
+        public_key = None
+        for attrtype, value in unpack_attrs(buffer):
+            if attrtype == WGPEER_A_PUBLIC_KEY:
+                public_key = format_key(value)
+            elif attrtype == WGPEER_A_PRESHARED_KEY:
+                peerdata['preshared-key'] = None if value == EMPTY_KEY else format_key(value)
+            elif attrtype == WGPEER_A_ENDPOINT:
+                peerdata['endpoint'] = format_sockaddr(value)
+            elif attrtype == WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL:
+                peerdata['persistent-keepalive'] = struct.unpack_from('=H', value)[0] or None
+            elif attrtype == WGPEER_A_LAST_HANDSHAKE_TIME:
+                peerdata['latest-handshake'] = struct.unpack_from('=q', value)[0]
+            elif attrtype == WGPEER_A_RX_BYTES:
+                peerdata['transfer-rx'] = struct.unpack_from('=Q', value)[0]
+            elif attrtype == WGPEER_A_TX_BYTES:
+                peerdata['transfer-tx'] = struct.unpack_from('=Q', value)[0]
+            elif attrtype == WGPEER_A_ALLOWEDIPS:
+                for _, allowedip in unpack_attrs(value):
+                    ip = dict(unpack_attrs(allowedip))
+                    family = struct.unpack_from('=H', ip[WGALLOWEDIP_A_FAMILY])[0]
+                    address = socket.inet_ntop(family, bytes(ip[WGALLOWEDIP_A_IPADDR]))
+                    peerdata['allowed-ips'].append('{0}/{1}'.format(address, ip[WGALLOWEDIP_A_CIDR_MASK][0]))
+        return public_key
+
+    def query_device(self, sock, family, interface):
+        '''Queries the given WireGuard interface and returns its attributes and peers'''
+        payload = pack_attr(WGDEVICE_A_IFNAME, interface.encode('utf8') + b'\0')
+        responses = self.request(sock, family, NLM_F_REQUEST | NLM_F_DUMP, WG_CMD_GET_DEVICE, WG_GENL_VERSION, payload)
+        items = { 'private-key': None, 'public-key': None, 'listen-port': 0, 'fwmark': None }
+        peers = dict() # ordered like the output of the "wg" command
+        for response in responses:
+            for attrtype, value in unpack_attrs(response):
+                if attrtype == WGDEVICE_A_PRIVATE_KEY:
+                    items['private-key'] = format_key(value)
+                elif attrtype == WGDEVICE_A_PUBLIC_KEY:
+                    items['public-key'] = format_key(value)
+                elif attrtype == WGDEVICE_A_LISTEN_PORT:
+                    items['listen-port'] = struct.unpack_from('=H', value)[0]
+                elif attrtype == WGDEVICE_A_FWMARK:
+                    fwmark = struct.unpack_from('=I', value)[0]
+                    items['fwmark'] = '0x{0:x}'.format(fwmark) if fwmark else None # string like in the "wg" command output
+                elif attrtype == WGDEVICE_A_PEERS:
+                    for _, peerbuffer in unpack_attrs(value):
+                        peerdata = { 'preshared-key': None, 'endpoint': None, 'allowed-ips': [], 'latest-handshake': 0,
+                                     'transfer-rx': 0, 'transfer-tx': 0, 'persistent-keepalive': None }
+                        public_key = self.parse_peer(peerbuffer, peerdata)
+                        if public_key in peers: # the last peer of a message is continued in the next one if there are many allowed ips
+                            peers[public_key]['allowed-ips'].extend(peerdata['allowed-ips'])
+                        else:
+                            peers[public_key] = peerdata
+        return items, peers
+
+    def query_devices(self, timeout=None):
+        '''Queries all WireGuard interfaces (or the one provided in the constructor) via netlink; returns a list of devices;
+           raises TimeoutError if the kernel does not answer within "timeout" seconds'''
+        devices = []
+        sock = self.socket_factory()
+        try:
+            sock.settimeout(timeout) # so that a worker thread does not stay blocked forever
+            family = self.resolve_family(sock)
+            interfaces = self.interface_lister() if self.interface == 'all' else [self.interface]
+            for interface in interfaces:
+                try:
+                    devices.append((interface, *self.query_device(sock, family, interface)))
+                except NetlinkError as e:
+                    if (self.interface == 'all') and (e.errno in [errno.ENODEV, errno.EOPNOTSUPP]): # not a WireGuard interface
+                        continue
+                    raise
+        finally:
+            sock.close()
+        return devices
+
+    def store_devices(self, devices):
+        '''Stores the queried devices in the same way as the parser of the "wg" command output does'''
+        for interface, items, peers in devices:
+            self.store_interfacedata(interface, items)
+            for peer, peerdata in peers.items():
+                if peerdata['endpoint'] is None:
+                    peerdata['endpoint'] = '(none)'
+                if len(peerdata['allowed-ips']) == 0:
+                    peerdata['allowed-ips'] = ['(none)']
+                self.store_peerdata(interface, peer, peerdata)
+
+    def retrieve_wireguard_data(self, data=None):
+        '''Sets the local data based on the WireGuard status queried via netlink'''
+        if data is None:
+            self.clear_data()
+        else:
+            self.data = data
+        if not self.fallback:
+            try:
+                self.store_devices(self.query_devices())
+                return
+            except OSError as e:
+                logger.warning('Querying WireGuard via netlink failed [{0}]; falling back to "wg" command'.format(e))
+                self.fallback = True
+        super().retrieve_wireguard_data(self.data)
+
+    async def retrieve_wireguard_data_async(self, data=None, timeout=None):
+        '''Sets the local data based on the WireGuard status queried via netlink in a worker thread'''
+        if not self.fallback:
+            loop = asyncio.get_event_loop()
+            try:
+                devices = await asyncio.wait_for(loop.run_in_executor(None, self.query_devices, timeout), timeout)
+            except (asyncio.TimeoutError, TimeoutError): # the worker thread ends as well due to the socket timeout
+                logger.error('Querying WireGuard via netlink did not finish within {0}s; keeping previous status'.format(timeout))
+                if data is not None:
+                    self.data = data
+                return
+            except OSError as e:
+                logger.warning('Querying WireGuard via netlink failed [{0}]; falling back to "wg" command'.format(e))
+                self.fallback = True
+            if not self.fallback:
+                if data is None:
+                    self.clear_data()
+                else:
+                    self.data = data
+                self.store_devices(devices) # store in the event loop to not modify the data tree concurrently
+                return
+        await super().retrieve_wireguard_data_async(data, timeout)